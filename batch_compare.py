@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+from PIL import Image
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from hash_index import load_or_build_index, get_index_path
+from compare_images import is_image, get_hash_functions, get_reference_hashes, \
+    get_batch_sum_normalized_deltas_from_hex, get_top_k, load_hash_config, parse_filters, pretty_time_delta, \
+    card_size, db_path, hash_config_path
+from result_cache import ResultCache, get_hashes_key, default_max_entries
+import metrics as metrics_module
+from metrics import metrics
+
+# Queries scored together. Scoring a block holds its float64 summed scores, a float64
+# temporary and one hash's uint16 distances, about block_size x index rows x 18 bytes
+# (around 350MB for 64 queries against 300k rows). HashIndex.batch_distances chunks the
+# rows, so the hash width doesn't add to that.
+default_block_size = 64
+default_top_k = 10
+csv_fields = ['image', 'rank', 'card_id', 'side', 'name', 'set_name', 'score']
+
+# Expands directories (recursively), globs and plain file paths into a list of image paths
+def get_query_paths(inputs: list[str]) -> list[str]:
+    paths = []
+    for input in inputs:
+        if os.path.isdir(input):
+            for root, dirs, files in os.walk(input):
+                dirs.sort()
+                paths.extend(os.path.join(root, file) for file in sorted(files) if is_image(file))
+        elif glob.has_magic(input):
+            paths.extend(path for path in sorted(glob.glob(input, recursive=True)) if is_image(path))
+        else:
+            paths.append(input)
+    return paths
+
+# Each pool worker rebuilds the HashFunctions from the registry once
+worker_hash_functions = []
+worker_rotate = 0
+
+def init_worker(registry: list[dict], rotate: int, hash_config: str):
+    global worker_hash_functions, worker_rotate
+    metrics.reset() # Forked workers start with a copy of the parent's, which it already has
+    worker_hash_functions = load_hash_config(get_hash_functions(registry), hash_config)
+    worker_rotate = rotate
+
+# Runs in a pool worker. Returns (path, {hash function id: hex}), or (path, None) if the image can't be read
+def hash_query(path: str):
+    try:
+        image = Image.open(path)
+        if worker_rotate:
+            image = image.rotate(worker_rotate, expand=True)
+        image = image.resize(card_size)
+        reference_hashes = get_reference_hashes(image, path, worker_hash_functions)
+    except OSError as e:
+        print(f"Couldn't read {path}: {e}", file=sys.stderr)
+        metrics.count('unreadable_images')
+        return path, None
+    return path, {hash_result.hash_function.id: str(hash_result.value) for hash_result in reference_hashes}
+
+# hash_query for pool workers, sending back the worker's metrics with each result
+def hash_query_with_metrics(path: str):
+    return hash_query(path) + (metrics.take(),)
+
+def merge_worker_metrics(result: tuple):
+    path, hex_dict, worker_metrics = result
+    metrics.merge(worker_metrics)
+    return path, hex_dict
+
+class ResultWriter(object):
+    def __init__(self, output, format: str):
+        self.output = output
+        self.format = format
+        if format == 'csv':
+            self.writer = csv.DictWriter(output, fieldnames=csv_fields)
+            self.writer.writeheader()
+
+    def write(self, path: str, results: list[dict]):
+        if self.format == 'csv':
+            for rank, result in enumerate(results):
+                self.writer.writerow({'image': path, 'rank': rank + 1, **{field: result[field] for field in csv_fields[2:]}})
+        else:
+            self.output.write(json.dumps({'image': path, 'results': results}) + '\n')
+        self.output.flush()
+
+# Scores the block's queries, skipping any whose hashes were already scored (duplicate cards in a lot)
+def score_block(block: list, hash_functions, index, top_k: int, writer: ResultWriter, cache: ResultCache, rows=None,
+        collapse_sides: bool = False, filters: dict = None):
+    keys = [get_hashes_key(hex_dict, hash_functions) for _, hex_dict in block]
+    results_by_key = {}
+    pending = {}
+    for key, (_, hex_dict) in zip(keys, block):
+        if key in results_by_key or key in pending:
+            cache.hit(key)
+            continue
+        results = cache.get(key, top_k)
+        if results is None:
+            cache.miss()
+            pending[key] = hex_dict
+        else:
+            results_by_key[key] = results
+
+    if len(pending) > 0:
+        sum_normalized_deltas = get_batch_sum_normalized_deltas_from_hex(list(pending.values()), hash_functions, index, rows)
+        cards = index.cards(rows) if collapse_sides else None
+        for key, scores in zip(pending, sum_normalized_deltas):
+            results = []
+            for position in get_top_k(scores, top_k, cards):
+                result = index.row(position if rows is None else int(rows[position]), filters)
+                result['score'] = float(scores[position])
+                results.append(result)
+            results_by_key[key] = results
+            cache.put([key], top_k, results)
+
+    for (path, _), key in zip(block, keys):
+        writer.write(path, results_by_key[key])
+    metrics.count('images_compared', len(block))
+    metrics.count('images_scored', len(pending))
+
+def batch_compare(paths: list[str], index, writer: ResultWriter, rotate: int = 0, top_k: int = default_top_k,
+        block_size: int = default_block_size, workers: int = 1, hash_config: str = hash_config_path,
+        cache: ResultCache = None, filters: dict = None, collapse_sides: bool = False) -> int:
+    hash_functions = load_hash_config(get_hash_functions(index.registry), hash_config)
+    if cache is None:
+        cache = ResultCache(default_max_entries)
+    rows = index.filter_rows(filters)
+    if rows is not None and len(rows) == 0:
+        raise Exception("No cards match the filters")
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(index.registry, rotate, hash_config))
+        hashed = map(merge_worker_metrics, pool.imap(hash_query_with_metrics, paths, chunksize=4))
+    else:
+        pool = None
+        init_worker(index.registry, rotate, hash_config)
+        hashed = map(hash_query, paths)
+
+    # Results are written as each block is scored, so output starts before every image is hashed
+    scored = 0
+    try:
+        block = []
+        for path, hex_dict in hashed:
+            if hex_dict is None:
+                continue
+            block.append((path, hex_dict))
+            if len(block) == block_size:
+                score_block(block, hash_functions, index, top_k, writer, cache, rows, collapse_sides, filters)
+                scored += len(block)
+                block = []
+        if len(block) > 0:
+            score_block(block, hash_functions, index, top_k, writer, cache, rows, collapse_sides, filters)
+            scored += len(block)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return scored
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the closest cards in the db for a whole batch of scans')
+    parser.add_argument('inputs', nargs='+', help='Image files, directories or globs')
+    parser.add_argument('--rotate', type=int, default=0, help='Degrees to rotate every image by before hashing')
+    parser.add_argument('--top-k', type=int, default=default_top_k)
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='jsonl')
+    parser.add_argument('--output', help='File to write results to. Defaults to stdout')
+    parser.add_argument('--block-size', type=int, default=default_block_size, help='Images scored against the index together')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes used to hash the images')
+    parser.add_argument('--hash-config', default=hash_config_path, help='Hash function subset and weights from select_hashes.py')
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    parser.add_argument('--filter', action='append', help='Only match cards with this metadata, e.g. "set_name=Core Set 2021" when sorting one set. Can be repeated')
+    parser.add_argument('--collapse-sides', action='store_true', help="Only list each card's best matching side")
+    metrics_module.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics_module.run(args.metrics, args.profile):
+        start = time.time()
+        paths = get_query_paths(args.inputs)
+        index = load_or_build_index(args.index or get_index_path(args.db), args.db)
+        output = open(args.output, 'w', newline='') if args.output else sys.stdout
+        cache = ResultCache()
+        try:
+            scored = batch_compare(paths, index, ResultWriter(output, args.format), args.rotate, args.top_k, args.block_size,
+                args.workers, args.hash_config, cache, parse_filters(args.filter), args.collapse_sides)
+        finally:
+            if args.output:
+                output.close()
+        end = time.time()
+        stats = cache.stats()
+        print(f'Compared {scored}/{len(paths)} images in {pretty_time_delta(end - start)}. '
+            f'{stats["hash_hits"]} repeated images reused earlier results', file=sys.stderr)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import urllib.parse
+import uuid
+import numpy
+import generate_database
+from hash_index import HashIndex, build_index, index_path
+from compare_images import get_hash_functions, get_reference_hashes, score_hashes, card_size
+
+# Offline, reproducible benchmark of the build and query paths. Builds a synthetic library
+# of random cards in a temp directory, hashes it with generate_database, then queries the
+# index with perturbed copies of library cards and reports throughput, latency, peak memory
+# and accuracy as json, so runs can be diffed across changes.
+
+default_cards = 500
+default_queries = 200
+default_seed = 0
+perturbations = ['none', 'rotate', 'blur', 'jpeg', 'crop', 'color']
+
+def make_card_image(rng: random.Random) -> Image.Image:
+    image = Image.new('RGB', card_size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randrange(8, 20)):
+        x, y = rng.randrange(card_size[0]), rng.randrange(card_size[1])
+        w, h = rng.randrange(20, 240), rng.randrange(20, 240)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle([x, y, x + w, y + h], fill=color)
+        else:
+            draw.ellipse([x, y, x + w, y + h], fill=color)
+    return image
+
+# Writes a library and matching scryfall bulk file in the layout download_images produces
+def make_library(card_count: int, rng: random.Random) -> dict:
+    card_objs = []
+    images = {}
+    for i in range(card_count):
+        set_name = f'Set {i % 10}'
+        card_obj = {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'name': f'Card {i}', 'set_name': set_name}
+        set_dir = os.path.join(generate_database.library_path, urllib.parse.quote_plus(set_name))
+        os.makedirs(set_dir, exist_ok=True)
+        image = make_card_image(rng)
+        image.save(os.path.join(set_dir, urllib.parse.quote_plus(card_obj['name'] + '.jpg')), quality=90)
+        card_objs.append(card_obj)
+        images[card_obj['id']] = image
+    with open(generate_database.scryfall_db_path, 'w') as scryfall_db_file:
+        json.dump(card_objs, scryfall_db_file)
+    return images
+
+def perturb(image: Image.Image, perturbation: str, rng: random.Random) -> Image.Image:
+    if perturbation == 'rotate':
+        return image.rotate(rng.uniform(-5, 5), resample=Image.BICUBIC, expand=False)
+    elif perturbation == 'blur':
+        return image.filter(ImageFilter.GaussianBlur(rng.uniform(1, 3)))
+    elif perturbation == 'jpeg':
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=rng.randrange(10, 40))
+        return Image.open(io.BytesIO(buffer.getvalue()))
+    elif perturbation == 'crop':
+        margin_x, margin_y = int(card_size[0] * 0.05), int(card_size[1] * 0.05)
+        return image.crop((margin_x, margin_y, card_size[0] - margin_x, card_size[1] - margin_y)).resize(card_size)
+    elif perturbation == 'color':
+        image = ImageEnhance.Color(image).enhance(rng.uniform(0.6, 1.4))
+        return ImageEnhance.Brightness(image).enhance(rng.uniform(0.7, 1.3))
+    return image
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+def get_percentile_ms(samples: list[float], percentile: float) -> float:
+    return round(float(numpy.percentile(samples, percentile)) * 1000, 3)
+
+# Parses "all;phash,dhash;colorhash" into named lists of HashFunctions
+def get_hash_function_sets(spec: str, hash_functions) -> dict:
+    sets = {}
+    for names in spec.split(';'):
+        if names == 'all':
+            sets['all'] = hash_functions
+        else:
+            keys = names.split(',')
+            sets[names] = [hf for hf in hash_functions if hf.id in keys or hf.name in keys or hf.name.split('.')[-1] in keys]
+    return sets
+
+def run_benchmark(card_count: int, query_count: int, workers: int, hash_sets: str, seed: int) -> dict:
+    rng = random.Random(seed)
+    results = {'cards': card_count, 'queries': query_count, 'workers': workers, 'seed': seed}
+
+    images = make_library(card_count, rng)
+
+    start = time.perf_counter()
+    generate_database.load_db()
+    hash_functions = generate_database.create_hash_functions()
+    generate_database.add_hash_functions(hash_functions)
+    generate_database.generate_db(hash_functions, workers)
+    build_time = time.perf_counter() - start
+    results['build'] = {'seconds': round(build_time, 3), 'images_per_second': round(card_count / build_time, 2)}
+
+    start = time.perf_counter()
+    build_index(generate_database.storage).save(index_path)
+    results['index_build_seconds'] = round(time.perf_counter() - start, 3)
+    load_times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        index = HashIndex.load(index_path)
+        load_times.append(time.perf_counter() - start)
+    results['index_load_ms'] = round(min(load_times) * 1000, 3)
+
+    hash_functions = get_hash_functions(index.registry)
+    card_ids = list(images.keys())
+    queries = []
+    for i in range(query_count):
+        card_id = rng.choice(card_ids)
+        perturbation = perturbations[i % len(perturbations)]
+        queries.append((card_id, perturbation, perturb(images[card_id], perturbation, rng)))
+
+    perturbation_counts = {perturbation: sum(1 for query in queries if query[1] == perturbation) for perturbation in perturbations}
+    # A near duplicate cluster's row counts as a match for every card in it
+    row_card_ids = [index.card_ids(row) for row in range(len(index))]
+    hash_function_sets = get_hash_function_sets(hash_sets, hash_functions)
+    accuracy = {}
+    for set_name, set_hash_functions in hash_function_sets.items():
+        latencies = []
+        top_1 = 0
+        top_10 = 0
+        by_perturbation = {perturbation: 0 for perturbation in perturbations}
+        for card_id, perturbation, image in queries:
+            start = time.perf_counter()
+            reference_hashes = get_reference_hashes(image, "reference_card", set_hash_functions)
+            best_rows = score_hashes(reference_hashes, set_hash_functions, index).top_k(10, collapse_sides=True)
+            latencies.append(time.perf_counter() - start)
+
+            best_card_ids = [row_card_ids[row] for row in best_rows]
+            if card_id in best_card_ids[0]:
+                top_1 += 1
+                by_perturbation[perturbation] += 1
+            if any(card_id in card_ids for card_ids in best_card_ids):
+                top_10 += 1
+        accuracy[set_name] = {
+            'hash_functions': [hf.id for hf in set_hash_functions],
+            'top_1': round(top_1 / query_count, 4),
+            'top_10': round(top_10 / query_count, 4),
+            'top_1_by_perturbation': {p: round(by_perturbation[p] / max(1, perturbation_counts[p]), 4) for p in perturbations},
+            'latency_p50_ms': get_percentile_ms(latencies, 50),
+            'latency_p99_ms': get_percentile_ms(latencies, 99)
+        }
+    results['query'] = accuracy
+    results['peak_rss_mb'] = get_peak_rss_mb()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark db build and query speed and accuracy on a synthetic library')
+    parser.add_argument('--cards', type=int, default=default_cards)
+    parser.add_argument('--queries', type=int, default=default_queries)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--hash-sets', default='all', help='Semicolon separated hash function sets to measure, e.g. "all;phash,dhash;colorhash"')
+    parser.add_argument('--seed', type=int, default=default_seed)
+    parser.add_argument('--output', help='File to write the json results to. Defaults to stdout')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir) # generate_database works relative to the current directory
+        sys.stdout = sys.stderr # Keep build progress out of the results
+        results = run_benchmark(args.cards, args.queries, args.workers, args.hash_sets, args.seed)
+        sys.stdout = sys.__stdout__
+        os.chdir('/')
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+from PIL import Image
+import argparse
+import numpy
+
+# Finds the card in a camera photo and warps it to the canonical card_size frame scryfall
+# images are in, so perceptual hashes compare like with like.
+#
+# Detection assumes a card on a reasonably plain background (a scanning rig). The photo is
+# shrunk, each pixel's colour distance from the median border colour is thresholded into a
+# foreground mask, the largest blob is taken as the card, and its convex hull is reduced to
+# the quadrilateral that keeps the most area.
+#
+# scipy is only imported by the functions that detect, so importing card_size and
+# rotate_card from here doesn't cost the query tools its few hundred ms of import time.
+
+card_size = (488, 680) # Size of scryfall "normal" images
+detection_size = 400 # Longest side of the copy detection runs on
+min_card_fraction = 0.05 # Blobs smaller than this fraction of the photo aren't cards
+# A rectified card is always portrait (see order_corners), so the only thing left to find
+# is which short edge is the top. 90 and 270 would have to squash it back into card_size.
+orientations = [0, 180]
+
+# Otsu's threshold over an array of 0-255 values
+def get_otsu_threshold(values: numpy.ndarray) -> float:
+    histogram = numpy.bincount(values.astype(numpy.uint8).ravel(), minlength=256).astype(numpy.float64)
+    weights = numpy.cumsum(histogram)
+    means = numpy.cumsum(histogram * numpy.arange(256))
+    total_weight = weights[-1]
+    total_mean = means[-1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        between = (total_mean * weights - means * total_weight) ** 2 / (weights * (total_weight - weights))
+    if numpy.isnan(between).all():
+        return 255.0 # Every value is the same (an empty, uniform view), so nothing stands out
+    return float(numpy.nanargmax(between))
+
+def get_foreground_mask(pixels: numpy.ndarray) -> numpy.ndarray:
+    import scipy.ndimage
+    border = numpy.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    background = numpy.median(border, axis=0)
+    distance = numpy.sqrt(((pixels - background) ** 2).sum(axis=2))
+    distance = numpy.clip(distance * 255 / max(distance.max(), 1), 0, 255)
+    mask = distance > get_otsu_threshold(distance)
+    mask = scipy.ndimage.binary_opening(mask, iterations=2)
+    return scipy.ndimage.binary_fill_holes(mask)
+
+def get_polygon_area(points: numpy.ndarray) -> float:
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * abs(numpy.dot(x, numpy.roll(y, 1)) - numpy.dot(y, numpy.roll(x, 1)))
+
+# Drops hull vertices one at a time, always the one whose removal loses the least area
+def reduce_to_quadrilateral(points: numpy.ndarray) -> numpy.ndarray:
+    points = list(points)
+    while len(points) > 4:
+        losses = []
+        for i in range(len(points)):
+            triangle = numpy.array([points[i - 1], points[i], points[(i + 1) % len(points)]])
+            losses.append(get_polygon_area(triangle))
+        del points[int(numpy.argmin(losses))]
+    return numpy.array(points, dtype=numpy.float64)
+
+# Orders corners clockwise starting so the first edge is one of the card's short edges,
+# i.e. the quad maps onto a portrait card. Which short edge is the top is left to orientation.
+def order_corners(corners: numpy.ndarray) -> numpy.ndarray:
+    center = corners.mean(axis=0)
+    angles = numpy.arctan2(corners[:, 1] - center[1], corners[:, 0] - center[0])
+    corners = corners[numpy.argsort(angles)] # Clockwise in image coordinates (y points down)
+    start = int(numpy.argmin(corners.sum(axis=1))) # Closest to the top left
+    corners = numpy.roll(corners, -start, axis=0)
+    first_edge = numpy.linalg.norm(corners[1] - corners[0])
+    second_edge = numpy.linalg.norm(corners[2] - corners[1])
+    if first_edge > second_edge:
+        corners = numpy.roll(corners, -1, axis=0)
+    return corners
+
+# Corners of the card in photo coordinates, or None if nothing card like was found
+def find_card_corners(photo: Image.Image):
+    import scipy.ndimage
+    import scipy.spatial
+    scale = detection_size / max(photo.size)
+    small = photo.convert('RGB')
+    if scale < 1:
+        small = small.resize((round(photo.width * scale), round(photo.height * scale)), Image.BILINEAR)
+    else:
+        scale = 1
+    pixels = numpy.asarray(small, dtype=numpy.float64)
+
+    labels, count = scipy.ndimage.label(get_foreground_mask(pixels))
+    if count == 0:
+        return None
+    sizes = numpy.bincount(labels.ravel())[1:]
+    card_label = int(numpy.argmax(sizes)) + 1
+    if sizes[card_label - 1] < min_card_fraction * labels.size:
+        return None
+
+    ys, xs = numpy.nonzero(labels == card_label)
+    points = numpy.stack([xs, ys], axis=1).astype(numpy.float64)
+    hull = scipy.spatial.ConvexHull(points)
+    corners = reduce_to_quadrilateral(points[hull.vertices])
+    return order_corners(corners) / scale
+
+# Coefficients for Image.transform(PERSPECTIVE), which maps output pixels back to input pixels
+def get_perspective_coefficients(output_corners: numpy.ndarray, input_corners: numpy.ndarray) -> numpy.ndarray:
+    matrix = []
+    for (x, y), (u, v) in zip(output_corners, input_corners):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+    return numpy.linalg.solve(numpy.array(matrix), input_corners.reshape(8))
+
+# Warps the card in the photo to card_size. Falls back to just resizing if no card is found,
+# turning a landscape photo portrait first so it isn't squashed.
+def rectify_card(photo: Image.Image) -> Image.Image:
+    corners = find_card_corners(photo)
+    if corners is None:
+        print("Couldn't find a card in the photo, using the whole image")
+        photo = photo.convert('RGB')
+        if photo.width > photo.height:
+            photo = photo.rotate(90, expand=True)
+        return photo.resize(card_size)
+    return warp_card(photo, corners)
+
+# Warps the quadrilateral found by find_card_corners to card_size
+def warp_card(photo: Image.Image, corners: numpy.ndarray) -> Image.Image:
+    width, height = card_size
+    output_corners = numpy.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=numpy.float64)
+    coefficients = get_perspective_coefficients(output_corners, corners)
+    return photo.convert('RGB').transform(card_size, Image.PERSPECTIVE, tuple(coefficients), Image.BICUBIC)
+
+# Turns a rectified card by one of orientations, keeping it card_size
+def rotate_card(card: Image.Image, rotation: int) -> Image.Image:
+    if rotation == 0:
+        return card
+    return card.rotate(rotation, expand=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the card in a photo and write it out rectified to the card frame')
+    parser.add_argument('photo')
+    parser.add_argument('output')
+    args = parser.parse_args()
+
+    card = rectify_card(Image.open(args.photo))
+    card.save(args.output)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import time
+import numpy
+from db_storage import open_storage
+from hash_index import HashIndex, build_index, get_clusters_path, get_index_path, load_clusters, pretty_time_delta, \
+    POPCOUNT_TABLE, db_path
+from multi_index import build_multi_indexes
+
+# Finds card sides whose images are near duplicates under every stored hash, e.g. reprints
+# with the same art and basic lands, and writes them out as clusters next to the db.
+#
+# Candidates come from multi-index hashing on the 64+ bit hashes: every row within radius
+# bits of another on one of them. A candidate pair is only a duplicate if its absolute
+# distance (mean fraction of differing bits over every hash function, as in
+# ScoreVectors.absolute_distances) is at most max_distance. Duplicate pairs are joined
+# with union-find into groups of rows reachable through duplicate pairs. A chain of pairs
+# can link rows much further apart than max_distance, so each group is then split into
+# clusters whose members are all within max_distance of the cluster's first row, the
+# representative the index keeps.
+#
+# The index then keeps one representative row per cluster and the rest are listed in its
+# record (see hash_index.collapse_clusters). That shrinks the searched rows, and a match on
+# a representative says straight away that the scan can't tell its duplicates apart.
+
+default_radius = 4
+default_max_distance = 0.05
+
+class UnionFind(object):
+    def __init__(self, size: int):
+        self.parents = numpy.arange(size)
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return int(root)
+
+    # The smaller row becomes the root, so a cluster's representative is its first row
+    def union(self, a: int, b: int):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            self.parents[max(a, b)] = min(a, b)
+
+# Absolute distance from row to each of the other rows
+def get_absolute_distances(index: HashIndex, row: int, others: numpy.ndarray) -> numpy.ndarray:
+    distances = numpy.zeros(len(others))
+    for id in index.hash_function_ids:
+        matrix = index.matrices[id]
+        deltas = POPCOUNT_TABLE[numpy.bitwise_xor(matrix[others], matrix[row])].sum(axis=1, dtype=numpy.uint16)
+        distances += deltas / index.bits(id)
+    return distances / len(index.hash_function_ids)
+
+# Rows within radius of row on any multi indexed hash, or every row if no hash is long enough
+def get_candidates(index: HashIndex, multi_indexes: dict, row: int, radius: int) -> numpy.ndarray:
+    if len(multi_indexes) == 0:
+        return numpy.arange(len(index))
+    rows = [multi_index.search(index.matrices[id][row], radius)[0] for id, multi_index in multi_indexes.items()]
+    return numpy.unique(numpy.concatenate(rows))
+
+# Splits a union-find group (sorted rows) into clusters of rows within max_distance of their
+# first row. Rows left out start the next cluster, so no member is further than max_distance
+# from its representative.
+def split_group(index: HashIndex, group: numpy.ndarray, max_distance: float) -> list:
+    cards = index.cards()
+    clusters = []
+    while len(group) > 1:
+        rest = group[1:]
+        close = (get_absolute_distances(index, int(group[0]), rest) <= max_distance) & (cards[rest] != cards[group[0]])
+        clusters.append(numpy.concatenate([group[:1], rest[close]]))
+        group = rest[~close]
+    return [cluster for cluster in clusters if len(cluster) > 1]
+
+# Clusters of two or more rows, each a sorted array of rows
+def find_clusters(index: HashIndex, radius: int = default_radius, max_distance: float = default_max_distance) -> list:
+    multi_indexes = build_multi_indexes(index)
+    if len(multi_indexes) == 0:
+        print('No hash is long enough for multi-index hashing, comparing all pairs')
+    cards = index.cards()
+    union_find = UnionFind(len(index))
+    for row in range(len(index)):
+        candidates = get_candidates(index, multi_indexes, row, radius)
+        # Each pair only needs checking once, and the sides of one card aren't duplicates of each other
+        candidates = candidates[(candidates > row) & (cards[candidates] != cards[row])]
+        if len(candidates) == 0:
+            continue
+        for other in candidates[get_absolute_distances(index, row, candidates) <= max_distance]:
+            union_find.union(row, int(other))
+
+    roots = numpy.array([union_find.find(row) for row in range(len(index))])
+    order = numpy.argsort(roots, kind='stable')
+    groups = numpy.split(order, numpy.flatnonzero(numpy.diff(roots[order])) + 1)
+    return [cluster for group in groups if len(group) > 1 for cluster in split_group(index, group, max_distance)]
+
+def save_clusters(path: str, index: HashIndex, clusters: list, radius: int, max_distance: float):
+    serialized = {
+        'radius': radius,
+        'max_distance': max_distance,
+        'clusters': [[[record['card_id'], record['side']] for record in map(index.row, map(int, rows))] for rows in clusters]
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as clusters_file:
+        clusters_file.write(json.dumps(serialized))
+    os.replace(tmp_path, path)
+
+def print_report(index: HashIndex, clusters: list, limit: int = 10):
+    duplicates = sum(len(rows) - 1 for rows in clusters)
+    print(f'{len(clusters)} clusters of near duplicates covering {duplicates + len(clusters)}/{len(index)} card sides, '
+        f'the index shrinks by {duplicates} rows')
+    for cluster_id, rows in sorted(enumerate(clusters), key=lambda cluster: -len(cluster[1]))[:limit]:
+        records = [index.row(int(row)) for row in rows]
+        names = sorted({record['side_name'] for record in records})
+        sets = sorted({record['set_name'] for record in records})
+        print(f'  cluster {cluster_id}: {len(rows)} sides of {", ".join(names)} across {len(sets)} sets')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cluster near duplicate card images in the db and rebuild the index with one row per cluster')
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    parser.add_argument('--radius', type=int, default=default_radius, help='Bits apart on a 64+ bit hash for two sides to be compared at all')
+    parser.add_argument('--max-distance', type=float, default=default_max_distance, help='Largest absolute distance (fraction of differing bits over every hash) between duplicates')
+    parser.add_argument('--report-only', action='store_true', help="Print the clusters without writing them or rebuilding the index")
+    args = parser.parse_args()
+
+    start = time.time()
+    storage = open_storage(args.db)
+    try:
+        # Clusters are always found over every side, not an index that was already clustered
+        index = build_index(storage)
+        clusters = find_clusters(index, args.radius, args.max_distance)
+        print_report(index, clusters)
+        if not args.report_only:
+            clusters_path = get_clusters_path(args.db)
+            save_clusters(clusters_path, index, clusters, args.radius, args.max_distance)
+            clustered = build_index(storage, load_clusters(clusters_path))
+            clustered.save(args.index or get_index_path(args.db))
+            print(f'Wrote clusters to {clusters_path} and indexed {len(clustered)} rows')
+    finally:
+        storage.close()
+    end = time.time()
+    print(pretty_time_delta(end - start))
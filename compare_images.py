@@ -6,8 +6,15 @@ import imagehash
 import numpy
 import json
 from typing import Union
+import argparse
 import hashlib
 import time
+from image_pipeline import prepare_image, pipeline_version
+from card_detection import card_size, orientations, rectify_card, rotate_card
+from hash_index import HashIndex, load_or_build_index, get_index_path
+from multi_index import build_multi_indexes, get_candidate_rows
+import metrics as metrics_module
+from metrics import metrics
 
 def is_image(filename):
     f = filename.lower()
@@ -16,19 +23,23 @@ def is_image(filename):
         f.endswith(".gif") or '.jpg' in f or  f.endswith(".svg")
 
 db_path = 'db.json'
+hash_config_path = 'hash_config.json' # Written by select_hashes.py
+# Early accept stops hashing once the best card is within accept_distance (the weighted
+# fraction of differing bits) and at least accept_margin closer than any other card.
+# Unrelated images differ in about half their bits, so 0.5 is the distance of a non match.
+default_accept_distance = 0.1
+default_accept_margin = 0.15
 userpaths = ['./library']
 image_filenames = []
 
-db = {}
-with open(db_path, 'r') as db_file:
-    db = json.load(db_file)
-
-# Represents the sum of many HashDeltas between two cards
+# Represents the sum of many HashDeltas between two cards. lhs_side is the face of the
+# lhs card that was compared, so both sides of a double faced card can be told apart.
 class MultiHashDelta(object):
-    def __init__(self, sum_normalized_deltas: str, lhs_card_id: str, rhs_card_id: str):
+    def __init__(self, sum_normalized_deltas: str, lhs_card_id: str, rhs_card_id: str, lhs_side: str = None):
         self.sum_normalized_deltas = sum_normalized_deltas
         self.lhs_card_id = lhs_card_id
         self.rhs_card_id = rhs_card_id
+        self.lhs_side = lhs_side
 
     def __add__(self, other):
         if isinstance(other, HashDelta):
@@ -37,7 +48,7 @@ class MultiHashDelta(object):
             elif self.rhs_card_id != other.rhs_card_id:
                 raise ValueError(f"rhs cards don't match. MultiHash: {self.rhs_card_id} SingleHash: {other.rhs_card_id}")
             else:
-                return MultiHashDelta(self.sum_normalized_deltas + other.normalized_value, self.lhs_card_id, self.rhs_card_id)
+                return MultiHashDelta(self.sum_normalized_deltas + other.normalized_value, self.lhs_card_id, self.rhs_card_id, self.lhs_side)
         else:
             raise TypeError(f"Can't add MultiHashDelta to {type(other)}")
 
@@ -80,7 +91,9 @@ class HashFunction(object):
         self.hash_size = hs
         self.function_args = args
         self.function_kwargs = kwargs
-        id_hash_input = str(self.name) + str(self.function_args) + str(self.function_kwargs)
+        self.weight = 1 # How much this hash counts towards the summed score, see load_hash_config
+        self.cost_ms = None # Measured time to compute, from the hash config if it has one
+        id_hash_input = str(self.name) + str(self.function_args) + str(self.function_kwargs) + f'pipeline{pipeline_version}'
         id_hash_input = id_hash_input.encode('UTF-8')
         self.id = hashlib.md5(id_hash_input).hexdigest()
 
@@ -96,8 +109,12 @@ class HashFunction(object):
     def __ne__(self, other):
         return not self == other
 
+    # img is either a PIL Image or a PreparedImage shared between several hash functions
     def hash(self, img, card_id):
-        return HashResult(self, self.function(img, *self.function_args, **self.function_kwargs), card_id)
+        img = prepare_image(img).input_for(self.function)
+        with metrics.timer(f'hash:{self.name}:{self.hash_size}'):
+            value = self.function(img, *self.function_args, **self.function_kwargs)
+        return HashResult(self, value, card_id)
 
 
 
@@ -159,113 +176,403 @@ def get_hash_function(hash: dict) -> HashFunction:
     hash_function = HashFunction(function, hash_size, *args, **kwargs)
     return hash_function
 
-# Get's all the HashFunctions from the database
-def get_hash_functions(json_db) -> list[HashFunction]:
+# Get's all the HashFunctions from the database's hash function registry
+def get_hash_functions(registry: list[dict]) -> list[HashFunction]:
     hash_functions = []
-    for hash_dict in json_db['hash_functions']:
+    for hash_dict in registry:
+        version = hash_dict.get('pipeline', 1)
+        if version != pipeline_version:
+            raise Exception(f"The db was hashed with image pipeline version {version}, this is version {pipeline_version}. "
+                "Rerun generate_database.py to rehash it")
         hash_functions.append(get_hash_function(hash_dict))
 
     return hash_functions
 
+# Narrows hash_functions down to the subset select_hashes.py recommended and sets their weights.
+# Hashes left out aren't computed for queries at all. Without a config every hash is used at weight 1.
+def load_hash_config(hash_functions: list[HashFunction], path: str = hash_config_path) -> list[HashFunction]:
+    if not os.path.isfile(path):
+        return hash_functions
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+    weights = {hash_config['id']: hash_config['weight'] for hash_config in config['hash_functions']}
+    costs = {metric['id']: metric['cost_ms'] for metric in config.get('metrics', [])}
+    selected = []
+    for hash_function in hash_functions:
+        if hash_function.id in weights:
+            hash_function.weight = weights[hash_function.id]
+            hash_function.cost_ms = costs.get(hash_function.id)
+            selected.append(hash_function)
+    if len(selected) != len(weights):
+        raise Exception(f"{path} uses hash functions that aren't in the index")
+    return selected
+
 # Get's the HashResults for the reference image
 def get_reference_hashes(reference_image: Image, card_id: str, hash_functions: list[HashFunction]) -> list[HashResult]:
 
     hash_results = []
+    prepared_image = prepare_image(reference_image) # Decode and shrink once for every hash function
 
     for hash_function in hash_functions:
-        result = hash_function.hash(reference_image, card_id)
+        result = hash_function.hash(prepared_image, card_id)
         hash_results.append(result)
 
     return hash_results
 
-# Get's hash result from list of hash objects in db that matches given hash.
-# Card_id is given to pair with the HashResult for easier correlation later on
-def get_hash_result_from_hash_list(hash_list: list[dict], hash_function: HashFunction, card_id: str) -> HashResult:
-    for hash in hash_list:
-        if hash['id'] == hash_function.id:
-            hr = HashResult.from_hex(hash_function, hash['hash'], card_id)
-            return hr
-    raise Exception(f"No hash with id {id} found in list of hashes {hashes}")
-
 def get_hash_result_from_list_by_id(hash_list: list[HashResult], id: str):
     for hash_result in hash_list:
         if hash_result.hash_function.id == id:
             return hash_result
     raise Exception(f"No HashResult in list with HashFunction having id {id}")
 
-# Creates a list of HashResults for a specific HashFunction over the card_objs dict
-def get_hash_results_from_db(hash_function: HashFunction, card_objs: dict) -> list[HashResult]:
-    hash_results = []
-    for card_id, card_obj in card_objs.items():
-        card_name = card_obj['name']
-        set_name = card_obj['set_name']
-        sides = card_obj['sides']
-        for side in sides.values():
-            side_name = side['name']
-            hashes = side['hashes']
-            hash = get_hash_result_from_hash_list(hashes, hash_function, card_id)
-            hash_results.append(hash)
-
-    return hash_results
-
-def get_normalized_hash_deltas(reference_hash_result: HashResult, hash_results: list[HashResult]) -> list[HashDelta]:
-    deltas = [hash_result - reference_hash_result for hash_result in hash_results]
-    max_value = max(delta.value for delta in deltas)
-    for delta in deltas:
-        delta.normalize_to(max_value)
-
-    return deltas
-
-def get_sum_lists(list_a: list, list_b: list):
-    assert len(list_a) == len(list_b)
-    return [list_a[i] + list_b[i] for i in range(len(list_a))]
-
-def compare_hashes(reference_hashes: list[HashResult], hash_functions: list[HashFunction], json_db: dict):
-    card_objs_dict = json_db['cards']
-    multi_hash_deltas = []
-
-    rh_time = 0
-    hr_time = 0
-    nhd_time = 0
-
+# Indices of the k smallest scores, best first. argpartition only orders the k that are
+# kept, so this is linear in the number of scores rather than a full sort.
+#
+# Given the card number of every score (HashIndex.cards), only each card's best side is
+# kept so the two faces of a double faced card don't take up two of the k places.
+def get_top_k(scores: numpy.ndarray, k: int, cards: numpy.ndarray = None) -> numpy.ndarray:
+    with metrics.timer('ranking'):
+        if cards is None:
+            return get_smallest(scores, k)
+        # Most cards have one side, so a few more than k candidates nearly always hold k cards
+        candidates = k * 2
+        while True:
+            top = get_smallest(scores, candidates)
+            _, first = numpy.unique(cards[top], return_index=True)
+            best_sides = top[numpy.sort(first)]
+            if len(best_sides) >= k or candidates >= len(scores):
+                return best_sides[:k]
+            candidates *= 4
+
+def get_smallest(scores: numpy.ndarray, k: int) -> numpy.ndarray:
+    if k < len(scores):
+        top = numpy.argpartition(scores, k - 1)[0:k]
+    else:
+        top = numpy.arange(len(scores))
+    return top[numpy.argsort(scores[top], kind='stable')]
+
+# Per hash function distance vectors and their normalized sum for one reference image,
+# over every row of the index or just the given candidate rows. Position i in every
+# vector belongs to row rows[i] (or row i when scoring the whole index).
+# Distances are normalized by the hash's bit length, so a row scores the same however
+# many other rows are scored with it and a filtered, shortlisted or full scan rank alike.
+# HashDelta and MultiHashDelta are only built on request, for the positions being reported.
+class ScoreVectors(object):
+    def __init__(self, index: HashIndex, hash_functions: list[HashFunction], reference_card_id: str, rows: numpy.ndarray = None):
+        self.index = index
+        self.hash_functions = hash_functions
+        self.reference_card_id = reference_card_id
+        self.rows = rows
+        self.deltas = {}
+        self.sum_normalized_deltas = numpy.zeros(len(index) if rows is None else len(rows))
+
+    def __len__(self):
+        return len(self.sum_normalized_deltas)
+
+    def add(self, hash_function: HashFunction, deltas: numpy.ndarray):
+        self.deltas[hash_function.id] = deltas
+        self.sum_normalized_deltas += hash_function.weight * deltas / self.index.bits(hash_function.id) # Puts it in range 0-weight
+
+    def row(self, position: int) -> int:
+        return position if self.rows is None else int(self.rows[position])
+
+    # Positions of the k best scores, or of the k best cards with collapse_sides
+    def top_k(self, k: int, collapse_sides: bool = False) -> numpy.ndarray:
+        return get_top_k(self.sum_normalized_deltas, k, self.index.cards(self.rows) if collapse_sides else None)
+
+    def hash_delta(self, position: int, hash_function: HashFunction) -> HashDelta:
+        delta = HashDelta(hash_function, int(self.deltas[hash_function.id][position]), self.index.card_id(self.row(position)), self.reference_card_id)
+        delta.normalize_to(self.index.bits(hash_function.id))
+        return delta
+
+    def multi_hash_delta(self, position: int, filters: dict = None) -> MultiHashDelta:
+        record = self.index.row(self.row(position), filters)
+        return MultiHashDelta(float(self.sum_normalized_deltas[position]), record['card_id'], self.reference_card_id, record['side'])
+
+    def top_multi_hash_deltas(self, k: int, collapse_sides: bool = False, filters: dict = None) -> list[MultiHashDelta]:
+        return [self.multi_hash_delta(position, filters) for position in self.top_k(k, collapse_sides)]
+
+    # Weighted mean fraction of differing bits per position, the summed score over the total
+    # weight. Comparable between queries that used different numbers of hash functions.
+    def absolute_distances(self) -> numpy.ndarray:
+        distances = numpy.zeros(len(self))
+        total_weight = 0
+        for hash_function in self.hash_functions:
+            if hash_function.id in self.deltas:
+                distances += hash_function.weight * self.deltas[hash_function.id] / self.index.bits(hash_function.id)
+                total_weight += hash_function.weight
+        return distances / total_weight if total_weight > 0 else distances
+
+# Scores every row of the index, or only the given candidate rows
+def score_hashes(reference_hashes: list[HashResult], hash_functions: list[HashFunction], index: HashIndex, rows: numpy.ndarray = None) -> ScoreVectors:
+    scores = ScoreVectors(index, hash_functions, reference_hashes[0].card_id, rows)
     for hash_function in hash_functions:
-        start_rh = time.time()
         reference_hash = get_hash_result_from_list_by_id(reference_hashes, hash_function.id)
-        end_rh = time.time()
-        rh_time += end_rh - start_rh
-
-        start_hr = time.time()
-        hash_results = get_hash_results_from_db(hash_function, card_objs_dict)
-        end_hr = time.time()
-        hr_time += end_hr - start_hr
-
-        start_nhd = time.time()
-        normalized_hash_deltas = get_normalized_hash_deltas(reference_hash, hash_results)
-        end_nhd = time.time()
-        nhd_time += end_nhd - start_nhd
-        # On first pass just add the normalized hash deltas to the list
-        if len(multi_hash_deltas) == 0:
-            multi_hash_deltas.extend(normalized_hash_deltas)
+        query = index.pack_query(hash_function.id, str(reference_hash.value))
+        scores.add(hash_function, index.distances(hash_function.id, query, rows))
+    return scores
+
+# Scores several reference images against the index at once. Returns a (queries, rows)
+# matrix of summed normalized deltas, each hash function's distances for every query
+# coming from a single pass over its matrix.
+def get_batch_sum_normalized_deltas(reference_hash_lists: list[list[HashResult]], hash_functions: list[HashFunction], index: HashIndex,
+        rows: numpy.ndarray = None) -> numpy.ndarray:
+    hex_dicts = [{hash_result.hash_function.id: str(hash_result.value) for hash_result in reference_hashes} for reference_hashes in reference_hash_lists]
+    return get_batch_sum_normalized_deltas_from_hex(hex_dicts, hash_functions, index, rows)
+
+# Same as get_batch_sum_normalized_deltas, for reference hashes given as {hash function id: hex}.
+# With rows, only those rows are scored and column i belongs to rows[i].
+def get_batch_sum_normalized_deltas_from_hex(hex_dicts: list[dict], hash_functions: list[HashFunction], index: HashIndex,
+        rows: numpy.ndarray = None) -> numpy.ndarray:
+    sum_normalized_deltas = numpy.zeros((len(hex_dicts), len(index) if rows is None else len(rows)))
+    for hash_function in hash_functions:
+        queries = numpy.stack([index.pack_query(hash_function.id, hex_dict[hash_function.id]) for hex_dict in hex_dicts])
+        deltas = index.batch_distances(hash_function.id, queries, rows)
+        sum_normalized_deltas += hash_function.weight * deltas / index.bits(hash_function.id) # Same as ScoreVectors
+    return sum_normalized_deltas
+
+# Hashes a rectified card both ways up and scores them against the index in one
+# batched pass. Returns the rotation whose best match is closest, and that orientation's image.
+def find_best_orientation(card: Image.Image, hash_functions: list[HashFunction], index: HashIndex, rows: numpy.ndarray = None):
+    rotated = [rotate_card(card, rotation) for rotation in orientations]
+    reference_hash_lists = [get_reference_hashes(image, "reference_card", hash_functions) for image in rotated]
+    sum_normalized_deltas = get_batch_sum_normalized_deltas(reference_hash_lists, hash_functions, index, rows)
+    best = int(numpy.argmin(sum_normalized_deltas.min(axis=1)))
+    return orientations[best], rotated[best]
+
+# Cheapest first when the hash config measured their cost, otherwise in registry order
+def get_hash_functions_by_cost(hash_functions: list[HashFunction]) -> list[HashFunction]:
+    if any(hash_function.cost_ms is None for hash_function in hash_functions):
+        return list(hash_functions)
+    return sorted(hash_functions, key=lambda hash_function: hash_function.cost_ms)
+
+# Absolute distance to the runner-up minus the distance to the best match, counting only
+# rows of other cards so the two sides of one double faced card don't cancel out.
+# Returns (best position, margin), the margin is 1 if there's no other card.
+# With nothing scored at all there's no match, and best is None.
+def get_margin(distances: numpy.ndarray, index: HashIndex, rows: numpy.ndarray = None):
+    if len(distances) == 0:
+        return None, 0.0
+    top = get_top_k(distances, 2, index.cards(rows))
+    if len(top) < 2:
+        return int(top[0]), 1.0
+    return int(top[0]), float(distances[top[1]] - distances[top[0]])
+
+# Outcome of identify: the positions of the best matches, their absolute distances,
+# how far ahead the best one is, and how many hash functions it took
+class Match(object):
+    def __init__(self, scores: ScoreVectors, distances: numpy.ndarray, best: int, margin: float, accepted: bool):
+        self.scores = scores
+        self.distances = distances
+        self.best = best
+        self.margin = margin
+        self.accepted = accepted
+        self.hash_functions_used = len(scores.deltas)
+
+    def top_k(self, k: int, collapse_sides: bool = False) -> numpy.ndarray:
+        return get_top_k(self.distances, k, self.scores.index.cards(self.scores.rows) if collapse_sides else None)
+
+    def row(self, position: int) -> int:
+        return self.scores.row(position)
+
+    # The best match stands in for near duplicates (see cluster_duplicates.py) the scan can't tell apart
+    @property
+    def ambiguous(self) -> bool:
+        return len(self.scores.index.card_ids(self.row(self.best))) > 1
+
+# Hashes and scores one hash function at a time, cheapest first, and stops as soon as the
+# absolute distances make the best card a confident match. A near exact scan is usually
+# settled by the first hash, so the rest are never computed.
+def identify(image: Image.Image, hash_functions: list[HashFunction], index: HashIndex, rows: numpy.ndarray = None,
+        accept_distance: float = default_accept_distance, accept_margin: float = default_accept_margin) -> Match:
+    if rows is not None and len(rows) == 0:
+        raise ValueError("No rows to match against")
+    prepared_image = prepare_image(image)
+    scores = ScoreVectors(index, hash_functions, "reference_card", rows)
+    for hash_function in get_hash_functions_by_cost(hash_functions):
+        reference_hash = hash_function.hash(prepared_image, "reference_card")
+        query = index.pack_query(hash_function.id, str(reference_hash.value))
+        scores.add(hash_function, index.distances(hash_function.id, query, rows))
+        distances = scores.absolute_distances()
+        best, margin = get_margin(distances, index, rows)
+        if distances[best] <= accept_distance and margin >= accept_margin:
+            return Match(scores, distances, best, margin, True)
+    return Match(scores, distances, best, margin, False)
+
+# identify for a rectified card whose way up isn't known. The orientations are ranked by
+# their closest match under just the cheapest hash, then identified in that order and the
+# first one accepted wins, so a clear card costs about one hash per orientation plus
+# identify. Otherwise the orientation with the closest best match is returned.
+# Returns (rotation, Match).
+def identify_orientation(card: Image.Image, hash_functions: list[HashFunction], index: HashIndex, rows: numpy.ndarray = None,
+        accept_distance: float = default_accept_distance, accept_margin: float = default_accept_margin):
+    cheapest = get_hash_functions_by_cost(hash_functions)[0]
+    rotated = {rotation: rotate_card(card, rotation) for rotation in orientations}
+    closest = {}
+    for rotation, image in rotated.items():
+        query = index.pack_query(cheapest.id, str(cheapest.hash(image, "reference_card").value))
+        closest[rotation] = index.distances(cheapest.id, query, rows).min(initial=index.bits(cheapest.id))
+    best = None
+    for rotation in sorted(orientations, key=lambda rotation: closest[rotation]):
+        match = identify(rotated[rotation], hash_functions, index, rows, accept_distance, accept_margin)
+        if match.accepted:
+            return rotation, match
+        if best is None or match.distances[match.best] < best[1].distances[best[1].best]:
+            best = (rotation, match)
+    return best
+
+# Parses ["set_name=Core Set 2021", "colors=U,B", "released_after=2020-01-01"] into the
+# filters HashIndex.filter_rows takes. Values of the same field are alternatives.
+def parse_filters(specs: list[str]) -> dict:
+    filters = {}
+    for spec in specs or []:
+        field, values = spec.split('=', 1)
+        if field in ('released_after', 'released_before'):
+            filters[field] = values
         else:
-            multi_hash_deltas = get_sum_lists(multi_hash_deltas, normalized_hash_deltas)
+            filters.setdefault(field, []).extend(values.split(','))
+    return filters
 
-
-    multi_hash_deltas.sort(key=lambda mhd: mhd.sum_normalized_deltas)
-    print([(mhd.sum_normalized_deltas, mhd.lhs_card_id, mhd.rhs_card_id) for mhd in multi_hash_deltas[0:10]])
+# Finds a hash function by id, or by name for the first one registered with that name
+def find_hash_function(hash_functions: list[HashFunction], key: str) -> HashFunction:
+    for hash_function in hash_functions:
+        if hash_function.id == key:
+            return hash_function
+    for hash_function in hash_functions:
+        if hash_function.name == key or hash_function.name.split('.')[-1] == key:
+            return hash_function
+    raise Exception(f"No hash function with id or name {key}")
+
+# Parses a cascade spec like "dhash:500,phash:100" into (HashFunction, shortlist size) stages
+def parse_cascade(spec: str, hash_functions: list[HashFunction]) -> list[tuple]:
+    stages = []
+    for stage in spec.split(','):
+        key, shortlist = stage.rsplit(':', 1)
+        stages.append((find_hash_function(hash_functions, key), int(shortlist)))
+    return stages
+
+# Coarse to fine candidate selection. Each stage scores the rows that survived the previous
+# stage with one more hash function and keeps the best shortlist of them, so the expensive
+# full sum only ever sees the last shortlist. Stage scores accumulate, normalized by bit length.
+def get_cascade_rows(reference_hashes: list[HashResult], stages: list[tuple], index: HashIndex, rows: numpy.ndarray = None) -> numpy.ndarray:
+    rows = numpy.arange(len(index)) if rows is None else rows
+    scores = numpy.zeros(len(rows))
+    for hash_function, shortlist in stages:
+        reference_hash = get_hash_result_from_list_by_id(reference_hashes, hash_function.id)
+        query = index.pack_query(hash_function.id, str(reference_hash.value))
+        scores += index.distances(hash_function.id, query, rows) / index.bits(hash_function.id)
+        if len(rows) > shortlist:
+            keep = numpy.argpartition(scores, shortlist - 1)[0:shortlist]
+            rows = rows[keep]
+            scores = scores[keep]
+    return rows
+
+# Lists the near duplicates a matched row stands in for, if it's a cluster representative
+def print_duplicates(record: dict):
+    duplicates = record.get('duplicates', [])
+    if len(duplicates) > 0:
+        print(f'Ambiguous, {len(duplicates)} near duplicates look the same: ' +
+            ', '.join(f'{duplicate["card_id"]} ({duplicate["set_name"]})' for duplicate in duplicates))
+
+def compare_hashes(reference_hashes: list[HashResult], hash_functions: list[HashFunction], index: HashIndex, rows: numpy.ndarray = None,
+        collapse_sides: bool = False, filters: dict = None):
+    start_score = time.time()
+    scores = score_hashes(reference_hashes, hash_functions, index, rows)
+    end_score = time.time()
+
+    start_rank = time.time()
+    # Only the reported rows get their metadata decoded
+    multi_hash_deltas = scores.top_multi_hash_deltas(10, collapse_sides, filters)
+    end_rank = time.time()
+
+    print([(mhd.sum_normalized_deltas, mhd.lhs_card_id, mhd.lhs_side, mhd.rhs_card_id) for mhd in multi_hash_deltas])
     print()
+    distances = scores.absolute_distances()
+    best, margin = get_margin(distances, index, rows)
+    if best is None:
+        print('No match, there were no candidates to score')
+    else:
+        best_record = index.row(scores.row(best), filters)
+        print(f'Best match {best_record["card_id"]} ({best_record["side"]}) at distance {round(float(distances[best]), 4)}, margin {round(margin, 4)}')
+        print_duplicates(best_record)
     print()
-    print(f'Time spent obtaining reference hash: {rh_time}')
-    print(f'Time spent grabbing hash results from database: {hr_time}')
-    print(f'Time spent normalizing hash deltas: {nhd_time}')
+    print(f'Time spent scoring hash distances: {end_score - start_score}')
+    print(f'Time spent ranking: {end_rank - start_rank}')
 
 if __name__ == "__main__":
-    test_image = Image.open('heliods_pilgrim.jpg')
-    test_image = test_image.rotate(-90, expand=True)
-    test_image = test_image.resize((488, 680))
-
-    start = time.time()
-    hash_functions = get_hash_functions(db)
-    reference_hashes = get_reference_hashes(test_image, "reference_card", hash_functions)
-    compare_hashes(reference_hashes, hash_functions, db)
-    end = time.time()
-    print(pretty_time_delta(end - start))
+    parser = argparse.ArgumentParser(description='Find the closest cards in the db to an image')
+    parser.add_argument('image', nargs='?', default='heliods_pilgrim.jpg')
+    parser.add_argument('--rotate', type=int, default=-90, help='Degrees to rotate the image by before hashing')
+    parser.add_argument('--search-radius', type=int, help='Only score cards within this many bits of the image on one of the 64+ bit hashes, found with multi-index hashing instead of a full scan')
+    parser.add_argument('--cascade', help='Shortlist candidates in stages before the full score, e.g. "dhash:500,phash:100" keeps the best 500 by dhash, then the best 100 of those by dhash + phash')
+    parser.add_argument('--hash-config', default=hash_config_path, help='Hash function subset and weights from select_hashes.py. All hashes are used equally if it does not exist')
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    parser.add_argument('--detect', action='store_true', help='Find and rectify the card in a camera photo and pick its orientation, instead of using --rotate')
+    parser.add_argument('--filter', action='append', help='Only match cards with this metadata, e.g. "set_name=Core Set 2021", "colors=U,B", "side=front", "layout=transform" or "released_after=2020-01-01". Can be repeated')
+    parser.add_argument('--early-accept', action='store_true', help='Hash one function at a time, cheapest first, and stop at the first confident match')
+    parser.add_argument('--accept-distance', type=float, default=default_accept_distance, help='Largest absolute distance (fraction of differing bits) early accept takes as a match')
+    parser.add_argument('--accept-margin', type=float, default=default_accept_margin, help='How much closer than any other card an early accepted match must be')
+    parser.add_argument('--collapse-sides', action='store_true', help="Only list each card's best matching side, so the faces of a double faced card don't both take a place in the results")
+    metrics_module.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics_module.run(args.metrics, args.profile):
+        start = time.time()
+        index = load_or_build_index(args.index or get_index_path(args.db), args.db)
+        hash_functions = load_hash_config(get_hash_functions(index.registry), args.hash_config)
+
+        filters = parse_filters(args.filter)
+        filtered_rows = index.filter_rows(filters)
+        if filtered_rows is not None:
+            print(f'{len(filtered_rows)}/{len(index)} card sides match the filters')
+            if len(filtered_rows) == 0:
+                raise Exception("No cards match the filters")
+
+        test_image = Image.open(args.image)
+        if args.detect and args.early_accept:
+            test_image = rectify_card(test_image) # identify_orientation below picks the way up
+        elif args.detect:
+            rotation, test_image = find_best_orientation(rectify_card(test_image), hash_functions, index, filtered_rows)
+            print(f'Card detected, rotated by {rotation}')
+        else:
+            test_image = test_image.rotate(args.rotate, expand=True)
+            test_image = test_image.resize(card_size)
+
+        if args.early_accept:
+            if args.search_radius is not None or args.cascade:
+                raise Exception("--early-accept can't be used with --search-radius or --cascade")
+            start_score = time.time()
+            if args.detect:
+                rotation, match = identify_orientation(test_image, hash_functions, index, filtered_rows, args.accept_distance,
+                    args.accept_margin)
+                print(f'Card detected, rotated by {rotation}')
+            else:
+                match = identify(test_image, hash_functions, index, filtered_rows, args.accept_distance, args.accept_margin)
+            end_score = time.time()
+            records = [(position, index.row(match.row(position), filters)) for position in match.top_k(10, args.collapse_sides)]
+            print([(round(float(match.distances[position]), 4), record['card_id'], record['side']) for position, record in records])
+            print()
+            outcome = 'Accepted' if match.accepted else 'Best'
+            best_record = index.row(match.row(match.best), filters)
+            print(f'{outcome} {best_record["card_id"]} ({best_record["side"]}) at distance {round(float(match.distances[match.best]), 4)}, '
+                f'margin {round(match.margin, 4)} after {match.hash_functions_used}/{len(hash_functions)} hash functions')
+            print_duplicates(best_record)
+            print(f'Time spent hashing and scoring: {end_score - start_score}')
+        else:
+            reference_hashes = get_reference_hashes(test_image, "reference_card", hash_functions)
+            rows = filtered_rows
+            if args.search_radius is not None:
+                multi_indexes = build_multi_indexes(index)
+                queries = {hash_result.hash_function.id: index.pack_query(hash_result.hash_function.id, str(hash_result.value)) for hash_result in reference_hashes}
+                rows = get_candidate_rows(multi_indexes, queries, args.search_radius)
+                if filtered_rows is not None:
+                    rows = numpy.intersect1d(rows, filtered_rows)
+                print(f'{len(rows)} candidates within {args.search_radius} bits')
+            if args.cascade:
+                if args.search_radius is not None:
+                    raise Exception("--cascade and --search-radius can't be used together")
+                rows = get_cascade_rows(reference_hashes, parse_cascade(args.cascade, hash_functions), index, filtered_rows)
+            compare_hashes(reference_hashes, hash_functions, index, rows, args.collapse_sides, filters)
+        end = time.time()
+        print(pretty_time_delta(end - start))
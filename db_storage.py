@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+# Storage backends for the hash db. Both hold the hash function registry plus, for every
+# (card_id, side), the card's name, set and scryfall metadata and one hash per hash function id.
+#
+# JsonStorage is the original db.json layout: the whole db lives in memory as a dict and is
+# rewritten on save. SqliteStorage keeps it in a sqlite file with each hash as a BLOB of its
+# raw bits, writes go through transactions, and nothing is held in memory. The backend is
+# picked from the file extension, see open_storage.
+
+sqlite_extensions = ('.sqlite', '.sqlite3', '.db')
+
+# Raw bytes of a hex hash, left padded to a whole number of bytes. Odd length hashes read back
+# with one extra leading zero, which packs to the same hash_index row.
+def hex_to_bytes(hex: str) -> bytes:
+    return bytes.fromhex(hex.zfill(len(hex) + len(hex) % 2))
+
+class JsonStorage(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.db = {'cards':{}, 'hash_functions':[]}
+        if os.path.isfile(path):
+            with open(path, 'r') as db_file:
+                self.db = json.load(db_file)
+        # (card_id, side) -> ids of its hashes, filled in as sides are looked up so checking
+        # for a hash doesn't scan the side's hash list every time
+        self.hash_ids = {}
+
+    @property
+    def registry(self) -> list[dict]:
+        return self.db['hash_functions']
+
+    def add_hash_function(self, serialized: dict):
+        self.db['hash_functions'].append(serialized)
+
+    # Removes the hash function from the registry along with every hash it made
+    def remove_hash_function(self, id: str):
+        self.db['hash_functions'] = [hash_dict for hash_dict in self.db['hash_functions'] if hash_dict['id'] != id]
+        for card_obj in self.db['cards'].values():
+            for side_obj in card_obj['sides'].values():
+                side_obj['hashes'] = [hash for hash in side_obj['hashes'] if hash['id'] != id]
+        self.hash_ids = {}
+
+    def has_card(self, id: str) -> bool:
+        return id in self.db['cards']
+
+    def add_card(self, id: str, name: str, set_name: str, metadata: dict = {}):
+        self.db['cards'][id] = {
+            'name': name,
+            'set_name': set_name,
+            'metadata': metadata,
+            'sides': {}
+        }
+
+    # Ids of cards added before metadata was stored
+    def get_ids_without_metadata(self) -> list[str]:
+        return [id for id, card_obj in self.db['cards'].items() if 'metadata' not in card_obj]
+
+    def set_metadata(self, id: str, metadata: dict):
+        self.db['cards'][id]['metadata'] = metadata
+
+    def has_side(self, id: str, side: str) -> bool:
+        card_obj = self.db['cards'].get(id)
+        return card_obj is not None and side in card_obj['sides']
+
+    def add_side(self, id: str, side: str, name: str):
+        self.db['cards'][id]['sides'][side] = {
+            'name': name,
+            'hashes': []
+        }
+        self.hash_ids[(id, side)] = set()
+
+    # Ids of the hash functions the side has hashes for
+    def get_hash_ids(self, id: str, side: str) -> set:
+        hash_ids = self.hash_ids.get((id, side))
+        if hash_ids is None:
+            card_obj = self.db['cards'].get(id)
+            side_obj = card_obj['sides'].get(side) if card_obj else None
+            if not side_obj:
+                return set()
+            hash_ids = self.hash_ids[(id, side)] = {hash['id'] for hash in side_obj['hashes']}
+        return hash_ids
+
+    def add_hash(self, id: str, side: str, hash_func_id: str, hash_value: str):
+        self.db['cards'][id]['sides'][side]['hashes'].append({
+            'id': hash_func_id,
+            'hash': hash_value
+        })
+        self.get_hash_ids(id, side).add(hash_func_id)
+
+    def remove_side(self, id: str, side: str):
+        self.hash_ids.pop((id, side), None)
+        card_obj = self.db['cards'].get(id)
+        if card_obj:
+            card_obj['sides'].pop(side, None)
+            if len(card_obj['sides']) == 0:
+                del self.db['cards'][id]
+
+    # Nothing is written until save, an interrupted json build relies on the checkpoint instead
+    def commit(self):
+        pass
+
+    # Writes the db next to the real path and swaps it in so a crash mid-write can't lose it
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as db_file:
+            db_file.write(json.dumps(self.db))
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+    # (card_id, side, name, set_name, side_name, metadata, {hash function id: hex}) for every side, in db order
+    def iter_index_rows(self):
+        for card_id, card_obj in self.db['cards'].items():
+            for side, side_obj in card_obj['sides'].items():
+                hashes = {hash['id']: hash['hash'] for hash in side_obj['hashes']}
+                # dbs from before metadata was stored don't have it
+                metadata = card_obj.get('metadata', {})
+                yield card_id, side, card_obj['name'], card_obj['set_name'], side_obj['name'], metadata, hashes
+
+class SqliteStorage(object):
+    schema = '''
+        CREATE TABLE IF NOT EXISTS hash_functions (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            hash_size INTEGER NOT NULL,
+            args TEXT NOT NULL,
+            kwargs TEXT NOT NULL,
+            pipeline INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS cards (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            set_name TEXT NOT NULL,
+            metadata TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS sides (
+            card_id TEXT NOT NULL REFERENCES cards(id) ON DELETE CASCADE,
+            side TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (card_id, side)
+        );
+        CREATE TABLE IF NOT EXISTS hashes (
+            card_id TEXT NOT NULL,
+            side TEXT NOT NULL,
+            hash_function_id TEXT NOT NULL REFERENCES hash_functions(id),
+            hash BLOB NOT NULL,
+            PRIMARY KEY (card_id, side, hash_function_id),
+            FOREIGN KEY (card_id, side) REFERENCES sides(card_id, side) ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(self.schema)
+        # dbs from before metadata was stored
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(cards)')]
+        if 'metadata' not in columns:
+            self.connection.execute("ALTER TABLE cards ADD COLUMN metadata TEXT NOT NULL DEFAULT '{}'")
+        # and from before hash functions recorded the image_pipeline version they hash with
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(hash_functions)')]
+        if 'pipeline' not in columns:
+            self.connection.execute('ALTER TABLE hash_functions ADD COLUMN pipeline INTEGER NOT NULL DEFAULT 1')
+
+    @property
+    def registry(self) -> list[dict]:
+        rows = self.connection.execute('SELECT id, name, hash_size, args, kwargs, pipeline FROM hash_functions ORDER BY position')
+        return [{'name': name, 'hash_size': hash_size, 'args': json.loads(args), 'kwargs': json.loads(kwargs), 'pipeline': pipeline,
+            'id': id} for id, name, hash_size, args, kwargs, pipeline in rows]
+
+    def add_hash_function(self, serialized: dict):
+        position = self.connection.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM hash_functions').fetchone()[0]
+        self.connection.execute('INSERT INTO hash_functions VALUES (?, ?, ?, ?, ?, ?, ?)', (serialized['id'], position,
+            serialized['name'], serialized['hash_size'], json.dumps(serialized['args']), json.dumps(serialized['kwargs']),
+            serialized.get('pipeline', 1)))
+
+    def remove_hash_function(self, id: str):
+        self.connection.execute('DELETE FROM hashes WHERE hash_function_id = ?', (id,))
+        self.connection.execute('DELETE FROM hash_functions WHERE id = ?', (id,))
+
+    def has_card(self, id: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM cards WHERE id = ?', (id,)).fetchone() is not None
+
+    def add_card(self, id: str, name: str, set_name: str, metadata: dict = {}):
+        self.connection.execute('INSERT INTO cards VALUES (?, ?, ?, ?)', (id, name, set_name, json.dumps(metadata)))
+
+    def get_ids_without_metadata(self) -> list[str]:
+        return [id for id, in self.connection.execute("SELECT id FROM cards WHERE metadata = '{}'")]
+
+    def set_metadata(self, id: str, metadata: dict):
+        self.connection.execute('UPDATE cards SET metadata = ? WHERE id = ?', (json.dumps(metadata), id))
+
+    def has_side(self, id: str, side: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM sides WHERE card_id = ? AND side = ?', (id, side)).fetchone() is not None
+
+    def add_side(self, id: str, side: str, name: str):
+        self.connection.execute('INSERT INTO sides VALUES (?, ?, ?)', (id, side, name))
+
+    def get_hash_ids(self, id: str, side: str) -> set:
+        rows = self.connection.execute('SELECT hash_function_id FROM hashes WHERE card_id = ? AND side = ?', (id, side))
+        return {hash_function_id for hash_function_id, in rows}
+
+    def add_hash(self, id: str, side: str, hash_func_id: str, hash_value: str):
+        self.connection.execute('INSERT INTO hashes VALUES (?, ?, ?, ?)', (id, side, hash_func_id, hex_to_bytes(hash_value)))
+
+    def remove_side(self, id: str, side: str):
+        self.connection.execute('DELETE FROM sides WHERE card_id = ? AND side = ?', (id, side))
+        self.connection.execute('DELETE FROM cards WHERE id = ? AND NOT EXISTS (SELECT 1 FROM sides WHERE card_id = ?)', (id, id))
+
+    def commit(self):
+        self.connection.commit()
+
+    def save(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def iter_index_rows(self):
+        sides = self.connection.execute('''
+            SELECT sides.card_id, sides.side, cards.name, cards.set_name, sides.name, cards.metadata
+            FROM sides JOIN cards ON cards.id = sides.card_id
+            ORDER BY cards.rowid, sides.rowid''')
+        hashes = self.connection.cursor()
+        for card_id, side, name, set_name, side_name, metadata in sides:
+            rows = hashes.execute('SELECT hash_function_id, hash FROM hashes WHERE card_id = ? AND side = ?', (card_id, side))
+            yield card_id, side, name, set_name, side_name, json.loads(metadata), \
+                {hash_function_id: hash.hex() for hash_function_id, hash in rows}
+
+def open_storage(path: str):
+    if path.endswith(sqlite_extensions):
+        return SqliteStorage(path)
+    return JsonStorage(path)
+
+# Copies a db.json into a sqlite db in one transaction
+def migrate_json_to_sqlite(json_path: str, sqlite_path: str):
+    source = JsonStorage(json_path)
+    destination = SqliteStorage(sqlite_path)
+    existing = {hash_dict['id'] for hash_dict in destination.registry}
+    for hash_dict in source.registry:
+        if hash_dict['id'] not in existing:
+            destination.add_hash_function(hash_dict)
+    sides = 0
+    for card_id, side, name, set_name, side_name, metadata, hashes in source.iter_index_rows():
+        # Re-running the migration replaces sides that were copied before
+        destination.remove_side(card_id, side)
+        if not destination.has_card(card_id):
+            destination.add_card(card_id, name, set_name, metadata)
+        destination.add_side(card_id, side, side_name)
+        for hash_function_id, hash_value in hashes.items():
+            destination.add_hash(card_id, side, hash_function_id, hash_value)
+        sides += 1
+    destination.commit()
+    destination.close()
+    return sides
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Migrate a db.json hash db to sqlite')
+    parser.add_argument('json_path')
+    parser.add_argument('sqlite_path')
+    args = parser.parse_args()
+
+    start = time.time()
+    sides = migrate_json_to_sqlite(args.json_path, args.sqlite_path)
+    print(f'Migrated {sides} card sides from {args.json_path} to {args.sqlite_path} in {round(time.time() - start, 2)}s')
@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
-import json
+import argparse
 import os
 import time
 import shutil
+import tempfile
+import threading
 import requests
-import urllib
+import requests.adapters
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import scryfall_index
 
 
 card_library = 'library'
+bulk_data_url = 'https://api.scryfall.com/bulk-data'
+# See rate limiting here: https://scryfall.com/docs/api
+default_rate = 10 # Requests per second
+default_concurrency = 8
+default_retries = 5
+default_bulk_type = 'oracle_cards'
 
 def pretty_time_delta(seconds):
     seconds = int(seconds)
@@ -24,83 +36,221 @@ def pretty_time_delta(seconds):
     else:
         return '%ds' % (seconds,)
 
-def download_image(image_url, dest_path):
-    response = requests.get(image_url, stream=True)
+# Hands out request slots at a steady rate, allowing short bursts up to capacity.
+# Shared by every download thread so the whole process stays under the rate limit.
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
 
-    if response.status_code == 200:
-        # Set decode_content value to True, otherwise the downloaded image file's size will be zero.
-        response.raw.decode_content = True
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
 
-        # Open a local file with wb ( write binary ) permission.
-        with open(dest_path, 'wb') as f:
+    # Stops handing out tokens for a while, e.g. when the server sends Retry-After
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class Downloader(object):
+    def __init__(self, rate: float = default_rate, concurrency: int = default_concurrency, retries: int = default_retries, backoff: float = 1):
+        self.limiter = TokenBucket(rate, max(1, rate))
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        # One keep-alive connection per thread, shared across every download
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def get_retry_delay(self, response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass # HTTP dates aren't worth parsing here, fall back to backoff
+        return self.backoff * 2 ** attempt
+
+    # Returns True once image_url has been written to dest_path
+    def download_image(self, image_url, dest_path) -> bool:
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            response = None
+            try:
+                response = self.session.get(image_url, stream=True, timeout=30)
+                if response.status_code == 200:
+                    write_atomically(response, dest_path)
+                    return True
+                elif response.status_code == 429 or response.status_code >= 500:
+                    delay = self.get_retry_delay(response, attempt)
+                    print(f'Got {response.status_code} for {image_url}. Retrying in {delay}s')
+                    if response.status_code == 429:
+                        # Everyone is going too fast, not just this thread
+                        self.limiter.pause(delay)
+                    time.sleep(delay)
+                else:
+                    print(f'Error downloading {image_url}. Got {response.status_code}')
+                    return False
+            except (requests.RequestException, OSError) as e:
+                delay = self.get_retry_delay(None, attempt)
+                print(f'Error downloading {image_url}: {e}. Retrying in {delay}s')
+                time.sleep(delay)
+            finally:
+                if response is not None:
+                    response.close()
+        print(f'Giving up on {image_url} after {self.retries + 1} attempts')
+        return False
+
+    def submit(self, image_url, dest_path):
+        return self.executor.submit(self.download_image, image_url, dest_path)
+
+# Streams the response into a hidden temp file next to dest_path and renames it into place,
+# so an interrupted download never leaves a partial image where the db build will find it
+def write_atomically(response, dest_path):
+    # Set decode_content value to True, otherwise the downloaded image file's size will be zero.
+    response.raw.decode_content = True
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
             shutil.copyfileobj(response.raw, f)
-    elif response.status_code == 429:
-        print("Downloading too fast. Got 429 (Too many requests)")
-    else:
-        print("Error downloading file")
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
+# Yields the card objects of a bulk file as it downloads, saving a copy to bulk_path on the
+# way through so generate_database can build its card lookup from it afterwards
+def stream_bulk_download(download_uri, bulk_path):
+    with requests.get(download_uri, stream=True) as response:
+        response.raise_for_status()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(bulk_path)), prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as bulk_file:
+                def chunks():
+                    for chunk in response.iter_content(scryfall_index.bulk_chunk_size):
+                        bulk_file.write(chunk)
+                        yield chunk
+                yield from scryfall_index.iter_card_objects(chunks())
+            os.replace(tmp_path, bulk_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
-def load_json(json_file):
-    json_obj = None
-    with open(json_file, 'r') as json_file:
-        json_obj = json.load(json_file)
-    print(f'{len(json_obj)} card objects loaded')
-    return json_obj
+def get_bulk_download_uri(bulk_data_url, bulk_type):
+    res = requests.get(bulk_data_url).json()
+    for item in res["data"]:
+        if item["type"] == bulk_type:
+            return item["download_uri"]
+    raise Exception(f"No {bulk_type} bulk data at {bulk_data_url}")
 
-def download_face(name, set_name, image_url, download_dir):
+def download_face(name, set_name, image_url, download_dir, downloader: Downloader):
     if not os.path.exists(download_dir):
-        os.makedirs(download_dir) # Creates parents too
+        os.makedirs(download_dir, exist_ok=True) # Creates parents too
 
     download_path = os.path.join(download_dir, urllib.parse.quote_plus(name + '.jpg'))
     if os.path.exists(download_path):
         print(f'{name} ({set_name}) already exists at {download_path}.')
+        return None
     else:
         print(f'Downloading {name} ({set_name}) from {image_url} to {download_path}.')
-        download_image(image_url, download_path)
-        time.sleep(0.055) # Sleep for 55 milliseconds. See rate limiting here: https://scryfall.com/docs/api
+        return downloader.submit(image_url, download_path)
+
 
+# Waits for a finished download, returning 1 if it failed
+def wait_for_download(download) -> int:
+    return 0 if download.result() else 1
 
-def download_images(json_obj):
+# card_objs can be any iterable, cards are read from it as the downloader has room for them.
+# Only a few downloads per connection are queued at once so memory stays flat on bulk files
+# of any size.
+def download_images(card_objs, downloader: Downloader):
     if not os.path.exists(card_library):
         os.mkdir(card_library)
-    for entry in json_obj:
+    max_pending = downloader.concurrency * 4
+    pending = deque()
+    submitted = 0
+    failed = 0
+    cards = 0
+    for entry in card_objs:
+        cards += 1
+        faces = []
         card_set_name = entry['set_name']
         card_set_name_encoded = urllib.parse.quote_plus(card_set_name)
         # Double sided card
         if entry.get('image_uris', None) == None:
-            card_faces = entry['card_faces']
             download_dir = os.path.join(card_library, card_set_name_encoded, urllib.parse.quote_plus(entry['name']))
-            for index, face in enumerate(card_faces):
-                card_name = face['name']
-                # Append .back to card name if it has the same name as the front side
-                if index > 0 and card_name == card_faces[0]['name']:
-                    card_name += '.back'
+            # Faces with the same name as the front side get .back appended
+            for card_name, face in scryfall_index.get_face_names(entry):
                 card_image_url = face['image_uris']['normal'] # Download the "normal" card size
-                download_face(card_name, card_set_name, card_image_url, download_dir)
+                faces.append((card_name, card_image_url, download_dir))
         # Single sided card
         else:
             card_name = entry['name']
             card_image_url = entry['image_uris']['normal'] # Download the "normal" card size
             download_dir = os.path.join(card_library, card_set_name_encoded)
-            download_face(card_name, card_set_name, card_image_url, download_dir)
+            faces.append((card_name, card_image_url, download_dir))
+
+        for card_name, card_image_url, download_dir in faces:
+            download = download_face(card_name, card_set_name, card_image_url, download_dir, downloader)
+            if download is None:
+                continue
+            pending.append(download)
+            submitted += 1
+            if len(pending) >= max_pending:
+                failed += wait_for_download(pending.popleft())
+
+    while pending:
+        failed += wait_for_download(pending.popleft())
+    print(f'{cards} card objects read')
+    print(f'Downloaded {submitted - failed}/{submitted} images. {failed} failed.')
+    return failed
 
 if __name__ == "__main__":
-    json_obj = None
-    for file in os.listdir():
-        if file.startswith("oracle-cards-") and file.endswith(".json"):
-            try:
-                json_obj = load_json(file)
-                print("Loaded JSON from file " + file)
-            except:
-                pass
-    if not json_obj:
-        print("Loading JSON from scryfall API")
-        res = requests.get('https://api.scryfall.com/bulk-data').json()
-        for item in res["data"]:
-            if item["type"] == "oracle_cards":
-                json_obj = requests.get(item["download_uri"]).json()
+    parser = argparse.ArgumentParser(description='Download every card image in the scryfall bulk data')
+    parser.add_argument('--rate', type=float, default=default_rate, help='Most requests per second')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency, help='Downloads in flight at once')
+    parser.add_argument('--retries', type=int, default=default_retries, help='Retries for 429s, 5xxs and connection errors')
+    parser.add_argument('--bulk-data-url', default=bulk_data_url)
+    parser.add_argument('--bulk-type', default=default_bulk_type, help='Scryfall bulk data to download images for, e.g. oracle_cards, default_cards or all_cards')
+    args = parser.parse_args()
 
     start = time.time()
-    download_images(json_obj)
+    bulk_path = scryfall_index.find_bulk_file(args.bulk_type)
+    if bulk_path:
+        print("Streaming JSON from file " + bulk_path)
+        card_objs = scryfall_index.iter_bulk_file(bulk_path)
+    else:
+        print("Streaming JSON from scryfall API")
+        download_uri = get_bulk_download_uri(args.bulk_data_url, args.bulk_type)
+        bulk_path = os.path.basename(urllib.parse.urlparse(download_uri).path)
+        card_objs = stream_bulk_download(download_uri, bulk_path)
+
+    downloader = Downloader(args.rate, args.concurrency, args.retries)
+    try:
+        download_images(card_objs, downloader)
+    finally:
+        downloader.close()
+    # Build the card lookup generate_database uses
+    scryfall_index.load_lookup(bulk_path)
     end = time.time()
     print(f'Completed download in {pretty_time_delta(end - start)}.')
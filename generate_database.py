@@ -1,28 +1,69 @@
 #!/usr/bin/env python
 
 
+import argparse
+import io
 import json
+import multiprocessing
 import os
 import imagehash
-import urllib # For url decoding
+import urllib.parse # For url decoding
 from PIL import Image
 import time
 import hashlib
+from image_pipeline import prepare_image, pipeline_version
+import scryfall_index
+from hash_index import build_index, get_clusters_path, get_index_path, load_clusters
+from db_storage import open_storage
+import metrics as metrics_module
+from metrics import metrics
 
 library_path = './library'
 db_path = 'db.json'
+checkpoint_path = 'db.json.checkpoint'
+manifest_path = 'db.json.manifest'
+progress_interval = 100 # Images between progress lines
+progress_seconds = 10 # Longest time between progress lines
 scryfall_db_path = 'oracle-cards-20210315090415.json'
-scryfall_db = {}
-with open(scryfall_db_path, 'r') as scryfall_db_file:
-    scryfall_db = json.load(scryfall_db_file)
-
-db = {}
-
-if os.path.isfile(db_path):
-    with open(db_path, 'r') as db_file:
-        db = json.load(db_file)
-else:
-    db = {'cards':{}, 'hash_functions':[]}
+card_lookup = None
+card_metadata = None
+storage = None # JsonStorage or SqliteStorage, opened by load_db
+# Library relpath -> {'size', 'mtime', 'digest', 'id', 'side', 'hash_ids'} for every image in the db.
+# Lets update runs skip images that haven't changed without opening them.
+manifest = {}
+
+# The (set_name, name) -> id and id -> metadata tables are only needed for new cards,
+# so they're loaded the first time that happens
+def load_card_tables():
+    global card_lookup, card_metadata
+    if card_lookup is None:
+        tables = scryfall_index.load_tables(scryfall_db_path)
+        card_lookup = tables['cards']
+        card_metadata = tables['metadata']
+
+def get_card_lookup():
+    load_card_tables()
+    return card_lookup
+
+def get_card_metadata(id):
+    load_card_tables()
+    return card_metadata.get(id, {})
+
+def load_db(path: str = db_path):
+    global storage
+    storage = open_storage(path)
+
+def load_manifest(path: str):
+    global manifest
+    if os.path.isfile(path):
+        with open(path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+def save_manifest(path: str):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, path)
 
 def pretty_time_delta(seconds):
     seconds = int(seconds)
@@ -70,12 +111,15 @@ class HashFunction(object):
         self.hash_size = hs
         self.function_args = args
         self.function_kwargs = kwargs
-        id_hash_input = str(self.name) + str(self.function_args) + str(self.function_kwargs)
+        id_hash_input = str(self.name) + str(self.function_args) + str(self.function_kwargs) + f'pipeline{pipeline_version}'
         id_hash_input = id_hash_input.encode('UTF-8')
         self.id = hashlib.md5(id_hash_input).hexdigest()
 
+    # img is either a PIL Image or a PreparedImage shared between several hash functions
     def hash(self, img):
-        return self.function(img, *self.function_args, **self.function_kwargs)
+        img = prepare_image(img).input_for(self.function)
+        with metrics.timer(f'hash:{self.name}:{self.hash_size}'):
+            return self.function(img, *self.function_args, **self.function_kwargs)
 
     def serialize(self):
         return {
@@ -83,6 +127,7 @@ class HashFunction(object):
             'hash_size': self.hash_size,
             'args': self.function_args,
             'kwargs': self.function_kwargs,
+            'pipeline': pipeline_version,
             'id': self.id
         }
 
@@ -101,13 +146,32 @@ def create_hash_functions():
     hash_functions.append(h)
     return hash_functions
 
-# Adds list of HashFunctions to json db
+# Drops hash functions (and their hashes) computed by an older image_pipeline. Their hashes
+# don't match what queries hash to anymore, so every image gets rehashed with the current ids.
+def remove_stale_hash_functions():
+    for hash_dict in storage.registry:
+        version = hash_dict.get('pipeline', 1)
+        if version != pipeline_version:
+            print(f'Removing hash function with id {hash_dict["id"]} from image pipeline version {version}')
+            storage.remove_hash_function(hash_dict['id'])
+
+# The HashFunctions in the db's registry, in registry order
+def get_registered_hash_functions() -> list[HashFunction]:
+    known = {hash_function.id: hash_function for hash_function in create_hash_functions()}
+    hash_functions = []
+    for hash_dict in storage.registry:
+        if hash_dict['id'] not in known:
+            raise Exception(f"The db has hash function {hash_dict['name']} with id {hash_dict['id']}, which this version can't compute")
+        hash_functions.append(known[hash_dict['id']])
+    return hash_functions
+
+# Adds list of HashFunctions to the db's registry
 def add_hash_functions(hash_functions: list[HashFunction]):
     for hash_function in hash_functions:
         # Only add function if it isn't on there yet
-        if len([hf for hf in db['hash_functions'] if hf['id'] == hash_function.id]) == 0:
+        if len([hf for hf in storage.registry if hf['id'] == hash_function.id]) == 0:
             print(f'Adding hash function with id {hash_function.id}')
-            db['hash_functions'].append(hash_function.serialize())
+            storage.add_hash_function(hash_function.serialize())
         else:
             print(f'Hash function with id {hash_function.id} already exists. Skipping.')
 
@@ -127,107 +191,299 @@ def get_details_from_path(card_path):
     return set_name, card_name, side_name
 
 def get_card_id(card_path):
-    set_name, card_name, _ = get_details_from_path(card_path)
-    for card_obj in scryfall_db:
-        if card_obj['name'] == card_name and card_obj['set_name'] == set_name:
-            return card_obj['id']
+    set_name, card_name, side_name = get_details_from_path(card_path)
+    # Double sided cards are found by their directory's full name, falling back to the face's name
+    id = scryfall_index.get_card_id(get_card_lookup(), set_name, card_name, side_name)
+    if id:
+        return id
+    metrics.count('unresolved_card_ids')
     print(f"Couldn't find id for card {card_name} ({set_name}) at path {card_path}.")
 
 def add_new_card(card_path, id):
     set_name, card_name, _ = get_details_from_path(card_path)
+    storage.add_card(id, card_name, set_name, get_card_metadata(id))
 
-    db['cards'][id] = {
-        'name': card_name,
-        'set_name': set_name,
-        'sides': {}
-    }
+# Fills in the scryfall metadata of cards hashed before it was stored
+def add_missing_metadata():
+    ids = storage.get_ids_without_metadata()
+    if len(ids) > 0:
+        print(f'Adding metadata to {len(ids)} cards')
+        for id in ids:
+            storage.set_metadata(id, get_card_metadata(id))
 
 def add_new_side(card_path: str, side: str, id: str):
     _, _, side_name = get_details_from_path(card_path)
-    db['cards'][id]['sides'][side] = {
-        'name': side_name,
-        'hashes': []
-    }
-
-def hash_already_exists_for_side(card_obj, hash_func, side):
-    if card_obj:
-        side = card_obj['sides'].get(side)
-        if side:
-            hashes = side['hashes']
-            if any([hash_func.id == hash['id'] for hash in hashes]):
-                return True
-
-    return False
-
-def add_hash(img, card_path, id, hash_func, side="front"):
-    card_obj = db['cards'].get(id)
-    if hash_already_exists_for_side(card_obj, hash_func, side):
-        #print(f'Already have hash function {hash_func.name} with args {hash_func.function_args}, {hash_func.function_kwargs}. Skipping')
-        return
-
-    hash = {
-        'id': hash_func.id,
-        'hash': str(hash_func.hash(img))
-    }
-
+    storage.add_side(id, side, side_name)
 
-    if not card_obj:
+def add_hash_value(card_path, id, hash_func_id, hash_value, side="front"):
+    if not storage.has_card(id):
         add_new_card(card_path, id)
 
-    card_obj = db['cards'][id]
-    if not card_obj['sides'].get(side):
+    if not storage.has_side(id, side):
         add_new_side(card_path, side, id)
 
-    side = card_obj['sides'][side]
-    side['hashes'].append(hash)
-
-
-def generate_db(hash_functions: list[HashFunction]):
-    start_time = time.time()
-    total_images = 0
-    images_processed = 0
-    for root, dirs, files in os.walk(library_path):
-        total_images += len(files)
-    for set_name in os.listdir(library_path):
-        now = time.time()
-        delta_time = now - start_time
-        fraction_progress = images_processed/total_images
-        if fraction_progress != 0:
-            est_total_time = delta_time * 1/fraction_progress
-            est_time_remaining = est_total_time * (1-fraction_progress)
-            print(f'Processed {images_processed}/{total_images}. {round(fraction_progress*100, 2)}% est. {pretty_time_delta(est_time_remaining)}')
+    storage.add_hash(id, side, hash_func_id, hash_value)
+
+def remove_side(id, side):
+    storage.remove_side(id, side)
+
+# Drops a library file from the manifest, and its side from the db unless another file
+# in the manifest still holds the same (id, side)
+def remove_image(relpath):
+    entry = manifest.pop(relpath)
+    shared = any(other['id'] == entry['id'] and other['side'] == entry['side'] for other in manifest.values())
+    if not shared:
+        remove_side(entry['id'], entry['side'])
+
+def read_library_file(relpath):
+    path = os.path.join(library_path, relpath)
+    with metrics.timer('read'):
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+        stat = os.stat(path)
+    return data, {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': hashlib.sha1(data).hexdigest()}
+
+def stamp_matches(entry, stat):
+    return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+# Records the file's stamp along with the hash functions its side now has in the db
+def update_manifest(relpath, id, side, file_stamp):
+    manifest[relpath] = dict(file_stamp, id=id, side=side, hash_ids=sorted(storage.get_hash_ids(id, side)))
+
+# Side of one face image of a multi faced card. Faces are saved under their own names in a
+# directory named after the whole card ("Front // Back"), so the face's position in that
+# name is its position in scryfall's card_faces. Faces that share the front's name have
+# .back appended (see scryfall_index.get_face_names). position, the face's place among the
+# directory's files, is only used if the name doesn't say.
+def get_face_side(card_name: str, face_name: str, position: int) -> str:
+    if '.back' in face_name:
+        return "back"
+    face_names = urllib.parse.unquote_plus(card_name).split(' // ')
+    name = remove_extensions(urllib.parse.unquote_plus(face_name))
+    if name in face_names:
+        position = face_names.index(name)
+    if position == 0:
+        return "front"
+    if position == 1:
+        return "back"
+    return f"face{position + 1}"
+
+# Lists (relpath, side) for every image in the library
+def get_library_images():
+    images = []
+    for set_name in sorted(os.listdir(library_path)):
         set_path = os.path.join(library_path, set_name)
         if os.path.isdir(set_path):
-            for card_name in os.listdir(set_path):
+            for card_name in sorted(os.listdir(set_path)):
+                # Hidden files are partial downloads
+                if card_name.startswith('.'):
+                    continue
                 card_path = os.path.join(set_path, card_name)
 
                 # Single sided card
                 if os.path.isfile(card_path):
-                    img = Image.open(card_path)
-                    relpath = os.path.relpath(card_path, library_path)
-                    id = get_card_id(relpath)
-                    for hash_func in hash_functions:
-                        add_hash(img, relpath, id, hash_func)
-                    images_processed += 1
+                    images.append((os.path.relpath(card_path, library_path), "front"))
                 # Double sided card
                 elif os.path.isdir(card_path):
-                    for face_name in os.listdir(card_path):
+                    face_names = [face_name for face_name in sorted(os.listdir(card_path)) if not face_name.startswith('.')]
+                    for position, face_name in enumerate(face_names):
                         face_path = os.path.join(card_path, face_name)
-                        img = Image.open(face_path)
-                        relpath = os.path.relpath(face_path, library_path)
-                        id = get_card_id(relpath)
-                        side = "back" if ".back" in face_path else "front"
-                        for hash_func in hash_functions:
-                            add_hash(img, relpath, id, hash_func, side=side)
-                        images_processed += 1
+                        side = get_face_side(card_name, face_name, position)
+                        images.append((os.path.relpath(face_path, library_path), side))
+    return images
+
+def print_progress(start_time, images_processed, total_images):
+    delta_time = time.time() - start_time
+    fraction_progress = images_processed/total_images
+    if fraction_progress != 0:
+        est_total_time = delta_time * 1/fraction_progress
+        est_time_remaining = est_total_time * (1-fraction_progress)
+        print(f'Processed {images_processed}/{total_images}. {round(fraction_progress*100, 2)}% est. {pretty_time_delta(est_time_remaining)}')
+
+# Each pool worker keeps its own copy of the HashFunctions so tasks only carry indices
+worker_hash_functions = []
+
+def init_worker(hash_functions: list[HashFunction]):
+    global worker_hash_functions
+    metrics.reset() # Forked workers start with a copy of the parent's, which it already has
+    worker_hash_functions = hash_functions
+
+# Runs in a pool worker. Decodes one image and runs the requested hash functions over it.
+# The worker's timings for the image go back with the result, see merge_result_metrics.
+def hash_image(task):
+    relpath, id, side, hash_func_indices = task
+    data, file_stamp = read_library_file(relpath)
+    img = prepare_image(Image.open(io.BytesIO(data))) # Decode once for every hash function
+    hashes = {}
+    for i in hash_func_indices:
+        hash_func = worker_hash_functions[i]
+        hashes[hash_func.id] = str(hash_func.hash(img))
+    metrics.count('images_hashed')
+    metrics.count('hashes_computed', len(hashes))
+    return {'path': relpath, 'id': id, 'side': side, 'hashes': hashes, 'file': file_stamp, 'metrics': metrics.take()}
+
+# Moves a hash_image result's worker metrics into this process's, so they aren't checkpointed
+def merge_result_metrics(result):
+    metrics.merge(result.pop('metrics'))
+
+# Adds the hashes from hash_image to the db, skipping any the side already has
+def add_image_result(result):
+    existing = storage.get_hash_ids(result['id'], result['side'])
+    for hash_func_id, hash_value in result['hashes'].items():
+        if hash_func_id not in existing:
+            add_hash_value(result['path'], result['id'], hash_func_id, hash_value, result['side'])
+    update_manifest(result['path'], result['id'], result['side'], result['file'])
+
+# Replays the results of an interrupted run into the db
+def load_checkpoint(path: str) -> int:
+    if not os.path.isfile(path):
+        return 0
+    replayed = 0
+    with open(path, 'r') as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break # Torn write from the crash, everything before it is good
+            add_image_result(result)
+            replayed += 1
+    print(f'Resumed {replayed} images from checkpoint {path}')
+    return replayed
+
+# Rewrites a json db in one go, or commits what's left of a sqlite db's transaction
+def save_db():
+    storage.save()
+
+def generate_db(hash_functions: list[HashFunction], workers: int = 1, checkpoint: str = checkpoint_path):
+    start_time = time.time()
+    load_checkpoint(checkpoint)
+
+    hash_func_ids = {hash_func.id for hash_func in hash_functions}
+    library_images = get_library_images()
+
+    # Drop images that have been removed from the library
+    library_paths = {relpath for relpath, _ in library_images}
+    for relpath in [relpath for relpath in manifest if relpath not in library_paths]:
+        remove_image(relpath)
+        metrics.count('images_removed')
+        print(f'Removed {relpath} from db')
+
+    tasks = []
+    for relpath, side in library_images:
+        entry = manifest.get(relpath)
+        if entry and entry['side'] != side:
+            # Recorded before faces got their real side, every face used to be the front
+            print(f'{relpath} is the {side} side, rehashing')
+            remove_image(relpath)
+            entry = None
+        if entry:
+            stat = os.stat(os.path.join(library_path, relpath))
+            if not stamp_matches(entry, stat):
+                _, file_stamp = read_library_file(relpath)
+                if file_stamp['digest'] != entry['digest']:
+                    # The image itself changed so none of its old hashes are any good
+                    metrics.count('images_changed')
+                    print(f'{relpath} changed, rehashing')
+                    remove_image(relpath)
+                    entry = None
+                else:
+                    entry.update(file_stamp) # Touched but not changed
+            # Unchanged and already has every hash function. The db is checked rather than the
+            # manifest's hash_ids, in case the db was deleted or rebuilt since the manifest was written.
+            if entry and hash_func_ids.issubset(storage.get_hash_ids(entry['id'], entry['side'])):
+                metrics.count('images_unchanged')
+                continue
+
+        id = entry['id'] if entry else get_card_id(relpath)
+        if id is None:
+            continue
+        existing = storage.get_hash_ids(id, side)
+        missing = [i for i, hash_func in enumerate(hash_functions) if hash_func.id not in existing]
+        metrics.count('hashes_skipped_existing', len(hash_functions) - len(missing))
+        if len(missing) > 0:
+            tasks.append((relpath, id, side, missing))
+        else:
+            # Hashed before the manifest existed
+            _, file_stamp = read_library_file(relpath)
+            update_manifest(relpath, id, side, file_stamp)
+
+    total_images = len(tasks)
+    print(f'{total_images} images need hashing with {workers} workers')
+    if total_images == 0:
+        return
+
+    images_processed = 0
+    last_progress = time.time()
+    # Every finished image is appended to the checkpoint straight away so a crash only loses in-flight work
+    with open(checkpoint, 'a') as checkpoint_file:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(hash_functions,))
+            results = pool.imap_unordered(hash_image, tasks, chunksize=8)
+        else:
+            pool = None
+            init_worker(hash_functions)
+            results = map(hash_image, tasks)
+
+        try:
+            for result in results:
+                merge_result_metrics(result)
+                with metrics.timer('db_write'):
+                    add_image_result(result)
+                    checkpoint_file.write(json.dumps(result) + '\n')
+                    checkpoint_file.flush()
+                images_processed += 1
+                if images_processed % progress_interval == 0 or time.time() - last_progress >= progress_seconds:
+                    # A sqlite db keeps everything up to here even if the run dies
+                    with metrics.timer('db_write'):
+                        storage.commit()
+                    print_progress(start_time, images_processed, total_images)
+                    last_progress = time.time()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hash new or changed images in the library into the db')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes used to decode and hash images')
+    parser.add_argument('--hash-config', help="Only add the hash functions chosen by select_hashes.py to a new db. Hash functions the db already has are still computed for new images")
+    parser.add_argument('--checkpoint', help='Append only file finished images are recorded in, so interrupted runs can resume. Defaults to <db>.checkpoint')
+    parser.add_argument('--scryfall-db', default=scryfall_db_path, help='Scryfall bulk file card ids are looked up in. Any bulk type works, it is streamed rather than loaded whole')
+    parser.add_argument('--db', default=db_path, help='Where to store the hashes. A .sqlite (or .sqlite3, .db) path stores them in sqlite instead of json')
+    parser.add_argument('--index', help='Where to write the index built from the db. Defaults to <db>.index')
+    metrics_module.add_arguments(parser)
+    args = parser.parse_args()
+
     start = time.time()
-    hash_functions = create_hash_functions()
-    add_hash_functions(hash_functions)
-    generate_db(hash_functions)
-    #print(json.dumps(db, indent=2))
-    with open(db_path, 'w') as db_file:
-        db_file.write(json.dumps(db))
+    db_path = args.db
+    scryfall_db_path = args.scryfall_db
+    manifest_path = db_path + '.manifest'
+    checkpoint = args.checkpoint or db_path + '.checkpoint'
+    with metrics_module.run(args.metrics, args.profile):
+        with metrics.timer('db_load'):
+            load_db(db_path)
+            load_manifest(manifest_path)
+        remove_stale_hash_functions()
+        hash_functions = create_hash_functions()
+        if args.hash_config:
+            with open(args.hash_config, 'r') as config_file:
+                selected_ids = {hash_config['id'] for hash_config in json.load(config_file)['hash_functions']}
+            hash_functions = [hash_function for hash_function in hash_functions if hash_function.id in selected_ids]
+        add_hash_functions(hash_functions)
+        # The config only limits which hash functions get added. Every row of the index needs
+        # every registered hash, so new images get all of them.
+        hash_functions = get_registered_hash_functions()
+        add_missing_metadata()
+        generate_db(hash_functions, args.workers, checkpoint)
+        with metrics.timer('db_save'):
+            save_db()
+            save_manifest(manifest_path)
+        # The checkpoint is now merged into the db
+        if os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+        with metrics.timer('index_build'):
+            # Keeps the near duplicate clusters cluster_duplicates.py found for this db
+            build_index(storage, load_clusters(get_clusters_path(db_path))).save(args.index or get_index_path(db_path))
+        storage.close()
     end = time.time()
     print(pretty_time_delta(end - start))
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import struct
+import time
+import numpy
+from db_storage import open_storage
+from metrics import metrics
+
+db_path = 'db.json'
+index_path = db_path + '.index' # See get_index_path
+
+# On disk layout (all little endian):
+#   header        HEADER
+#   registry      json list of serialized HashFunctions (the db's 'hash_functions')
+#   hash entries  HASH_ENTRY per hash function: id, row width in bytes, offset of its matrix
+#   matrices      one packed uint8 (row_count, width) matrix per hash function
+#   row table     uint64[row_count + 1] offsets into the row blob
+#   card table    uint32[row_count] card number of every row, the same for every side of a card
+#   row blob      utf-8 json record per row (card_id, side, name, set_name, side_name
+#                 and whichever scryfall metadata the card has). The representative row of
+#                 a near duplicate cluster also has its cluster id and the records of the
+#                 duplicates that were left out of the index, see cluster_duplicates.py
+#   partitions    json {field: {value: [[start, end], ...]}} row ranges for every value
+#                 of every partition_fields field
+#   substrings    for every hash function of at least min_bits, in registry order, one
+#                 uint64[row_count] sorted substring values and uint32[row_count] row order
+#                 per substring (see get_substring_tables), for multi_index.py
+# Everything after the registry is used straight out of the mmap, and row records
+# are only decoded for the rows that actually get reported. The card table groups the
+# sides of double faced cards without decoding any records. Partitions are only
+# parsed the first time a query is filtered. The substring tables are built with the index
+# so a radius search never has to sort anything.
+MAGIC = b'MTGIDX\x00\x00'
+VERSION = 4
+HEADER = struct.Struct('<8sIIIIQQQQQ')
+HASH_ENTRY = struct.Struct('<32sIQ')
+ALIGNMENT = 8
+
+# Row metadata fields queries can be filtered on. Rows are sorted by set so each set is one
+# contiguous range. colors is a list, a row is in the partition of each of its colours.
+partition_fields = ['set_name', 'side', 'colors', 'layout', 'released_at']
+
+# Multi-index hashing splits hashes of at least min_bits into substrings of about substring_bits
+substring_bits = 16 # Keeps the number of probes per substring small for typical radii
+min_bits = 64 # Only the 64 and 100 bit hashes are long enough to be worth splitting
+
+# Date range filters, on top of filtering on any partition field
+range_filter_fields = ['released_after', 'released_before']
+batch_chunk_bytes = 1 << 24 # Most XORed bytes batch_distances holds at once, its popcounts take as much again
+
+# Number of set bits in every possible byte. Indexing this with an XORed
+# uint8 matrix gives the per-byte hamming distance in one vectorized step.
+POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+def pretty_time_delta(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days > 0:
+        return '%dd%dh%dm%ds' % (days, hours, minutes, seconds)
+    elif hours > 0:
+        return '%dh%dm%ds' % (hours, minutes, seconds)
+    elif minutes > 0:
+        return '%dm%ds' % (minutes, seconds)
+    else:
+        return '%ds' % (seconds,)
+
+# Packs a hex hash string (as written by str(ImageHash)) into a fixed width uint8 row.
+# The hex is left padded so every row of a hash function lines up bit for bit.
+def hex_to_packed(hex: str, width: int) -> numpy.ndarray:
+    if len(hex) > width * 2:
+        raise ValueError(f"Hash {hex} doesn't fit in {width} bytes")
+    return numpy.frombuffer(bytes.fromhex(hex.zfill(width * 2)), dtype=numpy.uint8)
+
+# Number of meaningful bits a serialized HashFunction produces. colorhash makes
+# 14 bins of hash_size bits, every other imagehash hash is hash_size x hash_size.
+def get_hash_bits(hash_dict: dict) -> int:
+    hash_size = hash_dict['hash_size']
+    if hash_dict['name'] == 'imagehash.colorhash':
+        return hash_size * 14
+    return hash_size * hash_size
+
+def align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def get_substring_count(bit_count: int) -> int:
+    return max(1, -(-bit_count // substring_bits))
+
+# [start, end) bit positions of each substring of a packed row, skipping the padding in
+# front of hashes that aren't a whole number of bytes
+def get_substring_bounds(width: int, bit_count: int) -> list[int]:
+    padding = width * 8 - bit_count
+    substring_count = get_substring_count(bit_count)
+    return [padding + bit_count * i // substring_count for i in range(substring_count + 1)]
+
+# Value of bits [start, end) of every row, as uint64
+def get_substring_values(bits: numpy.ndarray, start: int, end: int) -> numpy.ndarray:
+    weights = numpy.left_shift(numpy.uint64(1), numpy.arange(end - start - 1, -1, -1, dtype=numpy.uint64))
+    return (bits[:, start:end].astype(numpy.uint64) * weights).sum(axis=1, dtype=numpy.uint64)
+
+# (sorted values, rows in that order) for every substring of a packed matrix
+def get_substring_tables(matrix: numpy.ndarray, bit_count: int) -> list[tuple]:
+    bits = numpy.unpackbits(matrix, axis=1)
+    bounds = get_substring_bounds(matrix.shape[1], bit_count)
+    tables = []
+    for start, end in zip(bounds, bounds[1:]):
+        values = get_substring_values(bits, start, end)
+        order = numpy.argsort(values, kind='stable')
+        tables.append((values[order], order.astype(numpy.uint32)))
+    return tables
+
+# Checks filters from outside (e.g. a json request) and puts them in the form filter_rows
+# takes, with a single value for a partition field wrapped in a list. Raises ValueError.
+def normalize_filters(filters) -> dict:
+    if filters is None:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must map field names to values")
+    normalized = {}
+    for field, values in filters.items():
+        if field in range_filter_fields:
+            if not isinstance(values, str):
+                raise ValueError(f"{field} must be a YYYY-MM-DD date")
+        elif field in partition_fields:
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"{field} must be a value or a list of values")
+        else:
+            raise ValueError(f"Can't filter on {field}, only on {', '.join(partition_fields + range_filter_fields)}")
+        normalized[field] = values
+    return normalized
+
+# Whether a record's own metadata passes filters, matched the same way filter_rows matches rows
+def record_matches(record: dict, filters: dict) -> bool:
+    for field, values in filters.items():
+        if field in range_filter_fields:
+            after = filters.get('released_after') or ''
+            before = filters.get('released_before') or '9999'
+            if not after <= record.get('released_at', '') <= before:
+                return False
+        else:
+            value = record.get(field)
+            if not set(value if isinstance(value, list) else [value]) & set(values):
+                return False
+    return True
+
+# A cluster representative's record as the first of its members that passes filters, with
+# the others (the representative included) as its duplicates. The representative itself if
+# it passes or no single member does.
+def get_matching_member(record: dict, filters: dict) -> dict:
+    duplicates = record.get('duplicates', [])
+    if len(duplicates) == 0 or record_matches(record, filters):
+        return record
+    representative = {key: value for key, value in record.items() if key not in ('cluster', 'duplicates')}
+    members = [representative] + duplicates
+    for i, member in enumerate(members):
+        if record_matches(member, filters):
+            return dict(member, cluster=record['cluster'], duplicates=members[:i] + members[i + 1:])
+    return record
+
+# Collapses each value's sorted row numbers into [start, end) ranges. A cluster's
+# representative row is in the partitions of all of its duplicates too.
+def get_partitions(records: list[dict]) -> dict:
+    rows = {field: {} for field in partition_fields}
+    for row, record in enumerate(records):
+        for field in partition_fields:
+            row_values = set()
+            for source in [record] + record.get('duplicates', []):
+                values = source.get(field)
+                if values is not None:
+                    row_values.update(values if isinstance(values, list) else [values])
+            for value in sorted(row_values):
+                rows[field].setdefault(value, []).append(row)
+    partitions = {}
+    for field, value_rows in rows.items():
+        partitions[field] = {}
+        for value, value_row_list in value_rows.items():
+            ranges = []
+            for row in value_row_list:
+                if ranges and ranges[-1][1] == row:
+                    ranges[-1][1] = row + 1
+                else:
+                    ranges.append([row, row + 1])
+            partitions[field][value] = ranges
+    return partitions
+
+# Numbers the distinct card ids in order of first appearance, one number per row
+def get_card_numbers(records: list[dict]) -> numpy.ndarray:
+    numbers = {}
+    return numpy.array([numbers.setdefault(record['card_id'], len(numbers)) for record in records], dtype=numpy.uint32)
+
+# Holds every card side's hashes as one packed bit matrix per hash function.
+# Row i of every matrix belongs to the i'th record of the row table. A row is one
+# (card_id, side), card_numbers groups the rows of each card.
+class HashIndex(object):
+    def __init__(self, registry: list[dict], matrices: dict, row_offsets: numpy.ndarray, card_numbers: numpy.ndarray, row_blob,
+            partition_blob, substring_tables: dict):
+        self.registry = registry
+        self.hash_function_ids = [hash_dict['id'] for hash_dict in registry]
+        self.matrices = matrices
+        self.row_offsets = row_offsets
+        self.card_numbers = card_numbers
+        self.row_blob = row_blob
+        self.partition_blob = partition_blob
+        self.partitions = None
+        self.substring_tables = substring_tables # hash function id -> get_substring_tables, for the long hashes
+
+    def __len__(self):
+        return len(self.row_offsets) - 1
+
+    def width(self, hash_function_id: str) -> int:
+        return self.matrices[hash_function_id].shape[1]
+
+    # Bits the hash function actually uses. Rows are left padded with zeros up to width bytes.
+    def bits(self, hash_function_id: str) -> int:
+        for hash_dict in self.registry:
+            if hash_dict['id'] == hash_function_id:
+                return get_hash_bits(hash_dict)
+        raise Exception(f"No hash function with id {hash_function_id} in index")
+
+    # Hash functions long enough for multi-index hashing, which have substring tables
+    def multi_indexed_ids(self) -> list[str]:
+        return [id for id in self.hash_function_ids if self.bits(id) >= min_bits]
+
+    def pack_query(self, hash_function_id: str, hex: str) -> numpy.ndarray:
+        return hex_to_packed(hex, self.width(hash_function_id))
+
+    # Hamming distance from the packed query to every row, in row order,
+    # or only to the given rows
+    def distances(self, hash_function_id: str, query: numpy.ndarray, rows: numpy.ndarray = None) -> numpy.ndarray:
+        matrix = self.matrices.get(hash_function_id)
+        if matrix is None:
+            raise Exception(f"No hash function with id {hash_function_id} in index")
+        with metrics.timer('distance'):
+            if rows is not None:
+                matrix = matrix[rows]
+            xored = numpy.bitwise_xor(matrix, query)
+            return POPCOUNT_TABLE[xored].sum(axis=1, dtype=numpy.uint16)
+
+    # Hamming distances for several packed queries of the same hash function in one pass,
+    # to every row or only the given rows. Returns a (queries, rows) matrix. Rows are XORed
+    # a chunk at a time so the per byte intermediates stay within batch_chunk_bytes, and
+    # only the uint16 result grows with queries x rows.
+    def batch_distances(self, hash_function_id: str, queries: numpy.ndarray, rows: numpy.ndarray = None) -> numpy.ndarray:
+        matrix = self.matrices.get(hash_function_id)
+        if matrix is None:
+            raise Exception(f"No hash function with id {hash_function_id} in index")
+        with metrics.timer('distance'):
+            row_count = len(matrix) if rows is None else len(rows)
+            distances = numpy.empty((len(queries), row_count), dtype=numpy.uint16)
+            chunk_rows = max(1, batch_chunk_bytes // max(1, len(queries) * matrix.shape[1]))
+            for start in range(0, row_count, chunk_rows):
+                end = min(start + chunk_rows, row_count)
+                chunk = matrix[start:end] if rows is None else matrix[rows[start:end]]
+                xored = numpy.bitwise_xor(chunk[numpy.newaxis, :, :], queries[:, numpy.newaxis, :])
+                distances[:, start:end] = POPCOUNT_TABLE[xored].sum(axis=2, dtype=numpy.uint16)
+            return distances
+
+    # Decodes the metadata record for a single row. A cluster representative is in the
+    # partitions of all its duplicates, so with the filters the row was found under it's
+    # reported as the member that matched them (see get_matching_member).
+    def row(self, row: int, filters: dict = None) -> dict:
+        start = int(self.row_offsets[row])
+        end = int(self.row_offsets[row + 1])
+        record = json.loads(bytes(self.row_blob[start:end]).decode('UTF-8'))
+        return get_matching_member(record, filters) if filters else record
+
+    def card_id(self, row: int) -> str:
+        return self.row(row)['card_id']
+
+    # The row's card id followed by those of the near duplicates it stands in for
+    def card_ids(self, row: int) -> list[str]:
+        record = self.row(row)
+        return [record['card_id']] + [duplicate['card_id'] for duplicate in record.get('duplicates', [])]
+
+    # Card number of every row, or of the given rows. Rows with the same number are sides of one card.
+    def cards(self, rows: numpy.ndarray = None) -> numpy.ndarray:
+        return self.card_numbers if rows is None else self.card_numbers[rows]
+
+    def get_partitions(self) -> dict:
+        if self.partitions is None:
+            self.partitions = json.loads(bytes(self.partition_blob).decode('UTF-8'))
+        return self.partitions
+
+    # Rows matching every given filter, or None to mean every row. filters maps a
+    # partition field to the values allowed for it, plus optional released_after and
+    # released_before dates (inclusive, YYYY-MM-DD).
+    def filter_rows(self, filters: dict) -> numpy.ndarray:
+        if not filters:
+            return None
+        partitions = self.get_partitions()
+        mask = numpy.ones(len(self), dtype=bool)
+        for field, values in filters.items():
+            if field in range_filter_fields:
+                after = filters.get('released_after') or ''
+                before = filters.get('released_before') or '9999'
+                field_partitions = partitions['released_at']
+                values = [date for date in field_partitions if after <= date <= before]
+                field = 'released_at'
+            elif field in partition_fields:
+                field_partitions = partitions[field]
+            else:
+                raise Exception(f"Can't filter on {field}, only on {', '.join(partition_fields)}, released_after and released_before")
+            field_mask = numpy.zeros(len(self), dtype=bool)
+            for value in values:
+                for start, end in field_partitions.get(value, []):
+                    field_mask[start:end] = True
+            mask &= field_mask
+        return numpy.flatnonzero(mask)
+
+    def save(self, path: str):
+        registry = json.dumps(self.registry).encode('UTF-8')
+        offset = HEADER.size + len(registry) + HASH_ENTRY.size * len(self.hash_function_ids)
+        entries = []
+        for id in self.hash_function_ids:
+            offset = align(offset)
+            entries.append((id, self.width(id), offset))
+            offset += self.matrices[id].nbytes
+        row_table_offset = align(offset)
+        card_table_offset = row_table_offset + self.row_offsets.nbytes
+        blob_offset = card_table_offset + self.card_numbers.nbytes
+        substrings_offset = align(blob_offset + len(self.row_blob) + len(self.partition_blob))
+        header = HEADER.pack(MAGIC, VERSION, len(self), len(entries), len(registry),
+            row_table_offset, blob_offset, len(self.row_blob), len(self.partition_blob), substrings_offset)
+
+        # Write next to the real path and swap it in so readers never see half an index
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(header)
+            index_file.write(registry)
+            for id, width, matrix_offset in entries:
+                index_file.write(HASH_ENTRY.pack(id.encode('ascii'), width, matrix_offset))
+            for id, width, matrix_offset in entries:
+                index_file.write(b'\x00' * (matrix_offset - index_file.tell()))
+                index_file.write(numpy.ascontiguousarray(self.matrices[id]).tobytes())
+            index_file.write(b'\x00' * (row_table_offset - index_file.tell()))
+            index_file.write(self.row_offsets.astype('<u8').tobytes())
+            index_file.write(self.card_numbers.astype('<u4').tobytes())
+            index_file.write(bytes(self.row_blob))
+            index_file.write(bytes(self.partition_blob))
+            for id in self.multi_indexed_ids():
+                for values, order in self.substring_tables[id]:
+                    index_file.write(b'\x00' * (align(index_file.tell()) - index_file.tell()))
+                    index_file.write(values.astype('<u8').tobytes())
+                    index_file.write(order.astype('<u4').tobytes())
+        os.replace(tmp_path, path)
+
+    # Maps the index file into memory. Nothing but the header and registry is parsed,
+    # the matrices and row table are views straight into the mapping.
+    def load(path: str):
+        mapped = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        magic, version = struct.unpack_from('<8sI', mapped, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a hash index")
+        if version != VERSION:
+            raise ValueError(f"{path} is index version {version}, expected {VERSION}")
+        _, _, row_count, hash_function_count, registry_length, \
+            row_table_offset, blob_offset, blob_length, partitions_length, substrings_offset = HEADER.unpack_from(mapped, 0)
+
+        offset = HEADER.size
+        registry = json.loads(bytes(mapped[offset:offset + registry_length]).decode('UTF-8'))
+        offset += registry_length
+        matrices = {}
+        for _ in range(hash_function_count):
+            id, width, matrix_offset = HASH_ENTRY.unpack_from(mapped, offset)
+            offset += HASH_ENTRY.size
+            matrix = mapped[matrix_offset:matrix_offset + row_count * width]
+            matrices[id.decode('ascii')] = matrix.reshape((row_count, width))
+
+        card_table_offset = row_table_offset + (row_count + 1) * 8
+        row_offsets = mapped[row_table_offset:card_table_offset].view('<u8')
+        card_numbers = mapped[card_table_offset:blob_offset].view('<u4')
+        row_blob = mapped[blob_offset:blob_offset + blob_length]
+        partitions_offset = blob_offset + blob_length
+        partition_blob = mapped[partitions_offset:partitions_offset + partitions_length]
+
+        substring_tables = {}
+        offset = substrings_offset
+        for hash_dict in registry:
+            bit_count = get_hash_bits(hash_dict)
+            if bit_count < min_bits:
+                continue
+            tables = []
+            for _ in range(get_substring_count(bit_count)):
+                offset = align(offset)
+                values = mapped[offset:offset + row_count * 8].view('<u8')
+                offset += row_count * 8
+                order = mapped[offset:offset + row_count * 4].view('<u4')
+                offset += row_count * 4
+                tables.append((values, order))
+            substring_tables[hash_dict['id']] = tables
+        return HashIndex(registry, matrices, row_offsets, card_numbers, row_blob, partition_blob, substring_tables)
+
+# The index built from a db sits next to it under the db's full file name, like its
+# clusters, so db.json and db.sqlite in one directory each keep their own index
+def get_index_path(source_path: str = db_path) -> str:
+    return source_path + '.index'
+
+def get_clusters_path(source_path: str = db_path) -> str:
+    return source_path + '.clusters'
+
+# Near duplicate clusters written by cluster_duplicates.py, as lists of [card_id, side]
+# with the representative first. No clusters if the file doesn't exist.
+def load_clusters(path: str) -> list[list]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as clusters_file:
+        return json.load(clusters_file)['clusters']
+
+# Leaves every cluster's duplicates out of rows and adds their records to the
+# representative's, with the cluster id. Sides no longer in the db are ignored.
+def collapse_clusters(rows: list[tuple], clusters: list[list]) -> list[tuple]:
+    positions = {(record['card_id'], record['side']): i for i, (record, _) in enumerate(rows)}
+    removed = set()
+    for cluster_id, members in enumerate(clusters):
+        present = [positions[tuple(member)] for member in members if tuple(member) in positions]
+        if len(present) < 2:
+            continue
+        representative = rows[present[0]][0]
+        representative['cluster'] = cluster_id
+        representative['duplicates'] = [rows[i][0] for i in present[1:]]
+        removed.update(present[1:])
+    return [row for i, row in enumerate(rows) if i not in removed]
+
+# Flattens a db storage (see db_storage) into a HashIndex. Rows are every side of every card,
+# grouped by set and otherwise in db order. With near duplicate clusters only one row is
+# kept per cluster.
+def build_index(storage, clusters: list[list] = None) -> HashIndex:
+    registry = storage.registry
+    hash_function_ids = [hash_dict['id'] for hash_dict in registry]
+    rows = []
+    for card_id, side, name, set_name, side_name, metadata, hashes in storage.iter_index_rows():
+        for id in hash_function_ids:
+            if id not in hashes:
+                raise Exception(f"No hash with id {id} found for card {card_id} ({side})")
+        record = {
+            'card_id': card_id,
+            'side': side,
+            'name': name,
+            'set_name': set_name,
+            'side_name': side_name
+        }
+        record.update(metadata)
+        rows.append((record, hashes))
+    if clusters:
+        rows = collapse_clusters(rows, clusters)
+    rows.sort(key=lambda row: row[0]['set_name'])
+
+    records = [json.dumps(record).encode('UTF-8') for record, _ in rows]
+    card_numbers = get_card_numbers([record for record, _ in rows])
+    hex_columns = {id: [hashes[id] for _, hashes in rows] for id in hash_function_ids}
+    partition_blob = json.dumps(get_partitions([record for record, _ in rows])).encode('UTF-8')
+
+    matrices = {}
+    for id, hexes in hex_columns.items():
+        width = (max((len(hex) for hex in hexes), default=0) + 1) // 2
+        matrix = numpy.zeros((len(hexes), width), dtype=numpy.uint8)
+        for row, hex in enumerate(hexes):
+            matrix[row] = hex_to_packed(hex, width)
+        matrices[id] = matrix
+
+    substring_tables = {hash_dict['id']: get_substring_tables(matrices[hash_dict['id']], get_hash_bits(hash_dict))
+        for hash_dict in registry if get_hash_bits(hash_dict) >= min_bits}
+
+    row_offsets = numpy.zeros(len(records) + 1, dtype=numpy.uint64)
+    row_offsets[1:] = numpy.cumsum([len(record) for record in records])
+    return HashIndex(registry, matrices, row_offsets, card_numbers, b''.join(records), partition_blob, substring_tables)
+
+def index_is_fresh(path: str = index_path, source_path: str = db_path) -> bool:
+    if not os.path.isfile(path):
+        return False
+    if not os.path.isfile(source_path):
+        return True
+    # A sqlite db's latest writes can still be sitting in its write ahead log
+    source_paths = [source_path, source_path + '-wal', get_clusters_path(source_path)]
+    source_mtime = max(os.path.getmtime(p) for p in source_paths if os.path.isfile(p))
+    return os.path.getmtime(path) >= source_mtime
+
+# Maps the index from disk, only falling back to reading the db if the index
+# is missing or older than the db
+def load_or_build_index(path: str = index_path, source_path: str = db_path) -> HashIndex:
+    with metrics.timer('index_load'):
+        return load_or_build_index_untimed(path, source_path)
+
+def load_or_build_index_untimed(path: str, source_path: str) -> HashIndex:
+    if index_is_fresh(path, source_path):
+        try:
+            return HashIndex.load(path)
+        except ValueError as e:
+            if not os.path.isfile(source_path):
+                raise
+            print(f'{e}. Rebuilding from {source_path}')
+    else:
+        print(f'Index at {path} is missing or stale. Rebuilding from {source_path}')
+    # A json storage would take a missing file for an empty db and save an empty index as fresh
+    if not os.path.isfile(source_path):
+        raise Exception(f"No db at {source_path} to build the index from. Run generate_database.py or pass --db")
+    storage = open_storage(source_path)
+    try:
+        build_index(storage, load_clusters(get_clusters_path(source_path))).save(path)
+    finally:
+        storage.close()
+    return HashIndex.load(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rebuild the hash index from the db')
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    args = parser.parse_args()
+
+    start = time.time()
+    storage = open_storage(args.db)
+    index = build_index(storage, load_clusters(get_clusters_path(args.db)))
+    storage.close()
+    index.save(args.index or get_index_path(args.db))
+    end = time.time()
+    print(f'Indexed {len(index)} card sides of {len(numpy.unique(index.card_numbers))} cards over {len(index.hash_function_ids)} hash functions in {pretty_time_delta(end - start)}')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from PIL import Image
+import imagehash
+from metrics import metrics
+
+# Every hash function works on a tiny image (at most 40x40 for phash with hash_size=10,
+# and whash picks the largest power of 2 that fits), so there is no point decoding or
+# converting the full size scan for each of them. Images are decoded once, shrunk to
+# work_size, and the shared intermediates below are handed to every hash function.
+#
+# Library images and queries must go through exactly the same steps, or the same picture
+# hashes differently depending on where it came from. Queries arrive already decoded
+# (rotated, resized, converted), so nothing here may depend on how the file was decoded.
+work_size = (128, 178) # Keeps the 488x680 aspect of scryfall "normal" images
+
+# Part of every HashFunction id. Bump it whenever a change here changes hash values, so dbs
+# hashed by an older pipeline are noticed and rehashed instead of silently drifting.
+pipeline_version = 2
+
+# Hash functions that need colour. Everything else starts with a greyscale conversion.
+color_functions = [imagehash.colorhash]
+
+# Modes that shrink to the same pixels whether they're converted to RGB before or after, so
+# the conversion can run on the small copy. Anything else (palette, CMYK, alpha) is converted
+# at full size first, as palette images would otherwise be resized nearest neighbour.
+shrink_first_modes = ['RGB', 'L']
+
+class PreparedImage(object):
+    def __init__(self, img: Image.Image):
+        if img.mode not in shrink_first_modes:
+            img = img.convert('RGB')
+        if img.size != work_size:
+            # reducing_gap first box-reduces by a whole factor, so the LANCZOS pass only works on
+            # an image at most about twice work_size. The full size image is still decoded, this
+            # only makes the resampling cheap.
+            img = img.resize(work_size, Image.LANCZOS, reducing_gap=2.0)
+        self.rgb = img.convert('RGB')
+        self.grey = self.rgb.convert('L')
+
+    # The intermediate to pass to an imagehash function
+    def input_for(self, function) -> Image.Image:
+        if function in color_functions:
+            return self.rgb
+        return self.grey
+
+def prepare_image(img) -> PreparedImage:
+    if isinstance(img, PreparedImage):
+        return img
+    with metrics.timer('decode'):
+        return PreparedImage(img)
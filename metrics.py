@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import threading
+import time
+
+# Process wide stage timers and counters for the build and query paths.
+#
+#   with metrics.timer('decode'):
+#       ...
+#   metrics.count('images_hashed')
+#
+# Timers keep the call count, total and max seconds of each stage. Pool workers collect
+# their own and send them back with take(), for the parent to merge(). A run's metrics
+# can be written as json or in the Prometheus text format, and the run can be profiled
+# with cProfile, see add_arguments and run.
+
+prometheus_prefix = 'mtg_'
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {} # stage -> [calls, total seconds, max seconds]
+        self.counters = {}
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1, max_seconds: float = None):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds if max_seconds is None else max_seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, counter: str, n: int = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'timers': {stage: {'calls': calls, 'seconds': round(total, 6), 'max_seconds': round(max_seconds, 6)}
+                    for stage, (calls, total, max_seconds) in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    # Returns everything collected so far and starts over, for sending back from a worker
+    def take(self) -> dict:
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        for stage, timer in snapshot['timers'].items():
+            self.add_time(stage, timer['seconds'], timer['calls'], timer['max_seconds'])
+        for counter, n in snapshot['counters'].items():
+            self.count(counter, n)
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, key, kind in [('stage_seconds_total', 'seconds', 'counter'), ('stage_calls_total', 'calls', 'counter'),
+                ('stage_seconds_max', 'max_seconds', 'gauge')]:
+            lines.append(f'# TYPE {prometheus_prefix}{name} {kind}')
+            for stage, timer in snapshot['timers'].items():
+                lines.append(f'{prometheus_prefix}{name}{{stage="{stage}"}} {timer[key]}')
+        for counter, n in snapshot['counters'].items():
+            lines.append(f'# TYPE {prometheus_prefix}{counter}_total counter')
+            lines.append(f'{prometheus_prefix}{counter}_total {n}')
+        return '\n'.join(lines) + '\n'
+
+    # Prometheus text for .prom and .txt paths, json otherwise
+    def write(self, path: str):
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
+
+def add_arguments(parser):
+    parser.add_argument('--metrics', help='Write stage timings and counters to this file. .prom or .txt for Prometheus text format, json otherwise')
+    parser.add_argument('--profile', help='Profile the run with cProfile and write the stats here, for pstats or snakeviz')
+
+# Profiles the body if profile_path is set, and writes the metrics when it finishes
+@contextmanager
+def run(metrics_path: str = None, profile_path: str = None):
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield metrics
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if metrics_path:
+            metrics.write(metrics_path)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import itertools
+import numpy
+from hash_index import HashIndex, POPCOUNT_TABLE, get_substring_bounds, get_substring_values
+
+# Multi-index hashing (Norouzi et al.) over one hash function's matrix in a HashIndex.
+#
+# Each hash is split into m disjoint substrings and the rows are sorted by every
+# substring's value. If a row is within radius r of the query, then by pigeonhole at
+# least one of its substrings is within r // m of the query's, so probing each sorted
+# table with every value that close to the query substring finds every candidate.
+# Candidates are then checked against the full hash so only true matches come back.
+#
+# The sorted substring tables are built with the index and mapped straight from the index
+# file (see hash_index.get_substring_tables), so a MultiIndex costs nothing to set up.
+
+# All masks of the given length with at most radius bits set
+def get_flip_masks(length: int, radius: int) -> numpy.ndarray:
+    masks = [0]
+    for flips in range(1, radius + 1):
+        for positions in itertools.combinations(range(length), flips):
+            masks.append(sum(1 << position for position in positions))
+    return numpy.array(masks, dtype=numpy.uint64)
+
+class MultiIndex(object):
+    def __init__(self, index: HashIndex, hash_function_id: str):
+        self.index = index
+        self.hash_function_id = hash_function_id
+        self.matrix = index.matrices[hash_function_id]
+        self.bounds = get_substring_bounds(self.matrix.shape[1], index.bits(hash_function_id))
+        self.substring_count = len(self.bounds) - 1
+        self.tables = index.substring_tables[hash_function_id]
+
+    # Rows within radius of the packed query, and their distances
+    def search(self, query: numpy.ndarray, radius: int):
+        query_bits = numpy.unpackbits(query)[numpy.newaxis, :]
+        substring_radius = radius // self.substring_count
+        candidates = []
+        for (start, end), (values, order) in zip(zip(self.bounds, self.bounds[1:]), self.tables):
+            query_value = get_substring_values(query_bits, start, end)[0]
+            probes = numpy.bitwise_xor(query_value, get_flip_masks(end - start, substring_radius))
+            lows = numpy.searchsorted(values, probes, side='left')
+            highs = numpy.searchsorted(values, probes, side='right')
+            for low, high in zip(lows, highs):
+                if high > low:
+                    candidates.append(order[low:high])
+
+        if len(candidates) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.uint16)
+        rows = numpy.unique(numpy.concatenate(candidates)).astype(numpy.int64)
+        distances = POPCOUNT_TABLE[numpy.bitwise_xor(self.matrix[rows], query)].sum(axis=1, dtype=numpy.uint16)
+        within = distances <= radius
+        return rows[within], distances[within]
+
+# Builds a MultiIndex for every hash function long enough to benefit
+def build_multi_indexes(index: HashIndex) -> dict:
+    return {id: MultiIndex(index, id) for id in index.multi_indexed_ids()}
+
+# Union of the rows within radius of the query under any of the multi indexes.
+# queries maps hash function id to the packed query hash.
+def get_candidate_rows(multi_indexes: dict, queries: dict, radius: int) -> numpy.ndarray:
+    rows = [multi_index.search(queries[id], radius)[0] for id, multi_index in multi_indexes.items()]
+    if len(rows) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.unique(numpy.concatenate(rows))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from hash_index import HashIndex, load_or_build_index, normalize_filters, get_index_path, index_path
+from compare_images import HashFunction, HashResult, get_hash_functions, get_reference_hashes, \
+    get_batch_sum_normalized_deltas, get_top_k, load_hash_config, card_size, db_path, hash_config_path
+from result_cache import ResultCache, get_fingerprint, get_filters_key, get_image_key, get_hashes_key, default_max_entries
+from metrics import metrics
+
+default_port = 8765
+default_top_k = 10
+reload_check_interval = 1 # Seconds between checks for a rebuilt index
+
+# Collects queries from the request threads and scores whatever has queued up
+# within batch_window seconds in one pass over the index. With collapse_sides results
+# list each card once, at its best matching side.
+class QueryBatcher(object):
+    def __init__(self, index: HashIndex, hash_functions: list[HashFunction], batch_window: float, max_batch: int,
+            collapse_sides: bool = False):
+        self.index = index
+        self.hash_functions = hash_functions
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.collapse_sides = collapse_sides
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Swaps in a new index and hash functions, e.g. after generate_database rebuilt the index
+    def set_index(self, index: HashIndex, hash_functions: list[HashFunction]):
+        self.index = index
+        self.hash_functions = hash_functions
+
+    def submit(self, reference_hashes: list[HashResult], top_k: int, filters: dict = None) -> Future:
+        future = Future()
+        self.queue.put((reference_hashes, top_k, filters, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Queries with the same filters share one pass over their rows
+            groups = {}
+            for query in batch:
+                groups.setdefault(get_filters_key(query[2]), []).append(query)
+            metrics.count('batches')
+            for group in groups.values():
+                self.score(group)
+
+    def score(self, batch: list):
+        index = self.index
+        try:
+            rows = index.filter_rows(batch[0][2])
+            if rows is not None and len(rows) == 0:
+                # Valid filters that no card matches, e.g. a set that isn't in the index
+                for _, _, _, future in batch:
+                    future.set_result([])
+                return
+            sum_normalized_deltas = get_batch_sum_normalized_deltas(
+                [reference_hashes for reference_hashes, _, _, _ in batch], self.hash_functions, index, rows)
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        cards = index.cards(rows) if self.collapse_sides else None
+        for scores, (_, top_k, filters, future) in zip(sum_normalized_deltas, batch):
+            results = []
+            for position in get_top_k(scores, top_k, cards):
+                result = index.row(position if rows is None else int(rows[position]), filters)
+                result['score'] = float(scores[position])
+                results.append(result)
+            future.set_result(results)
+
+# Keeps the served index in step with the index file and the hash config. When either one
+# changes on disk it's reloaded, and the result cache empties itself on the next query.
+class IndexWatcher(object):
+    def __init__(self, index_path: str, hash_config: str, batcher: QueryBatcher, cache: ResultCache):
+        self.index_path = index_path
+        self.hash_config = hash_config
+        self.batcher = batcher
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.last_check = 0
+        self.stamp = self.get_stamp()
+        self.fingerprint = get_fingerprint(batcher.index, batcher.hash_functions)
+
+    def get_stamp(self):
+        stamps = []
+        for path in (self.index_path, self.hash_config):
+            stat = os.stat(path) if os.path.isfile(path) else None
+            stamps.append((stat.st_size, stat.st_mtime_ns) if stat else None)
+        return stamps
+
+    # Current hash functions and index fingerprint, reloading first if the files changed
+    def refresh(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_check >= reload_check_interval:
+                self.last_check = now
+                stamp = self.get_stamp()
+                if stamp != self.stamp:
+                    print(f'Reloading {self.index_path}')
+                    index = HashIndex.load(self.index_path)
+                    hash_functions = load_hash_config(get_hash_functions(index.registry), self.hash_config)
+                    self.batcher.set_index(index, hash_functions)
+                    self.fingerprint = get_fingerprint(index, hash_functions)
+                    self.stamp = stamp
+            self.cache.check(self.fingerprint)
+            return self.batcher.hash_functions
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    # Set on the class by serve()
+    batcher = None
+    cache = None
+    watcher = None
+
+    def send_json(self, status: int, obj):
+        body = json.dumps(obj).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status: int, text: str):
+        body = text.encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'card_sides': len(self.batcher.index), 'cache': self.cache.stats()})
+        elif self.path == '/stats':
+            self.send_json(200, {'cache': self.cache.stats()})
+        elif self.path == '/metrics':
+            # Stage timings and counters since the server started, in the Prometheus text format
+            self.send_text(200, metrics.to_prometheus())
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    # POST /identify with either the raw image bytes as the body, or a json body
+    # {"path": "...", "top_k": 10, "filters": {"set_name": ["..."]}} pointing at an image
+    # on the server's disk. See HashIndex.filter_rows for the filters.
+    def do_POST(self):
+        if self.path != '/identify':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        top_k = default_top_k
+        filters = None
+        is_json = self.headers.get('Content-Type', '').startswith('application/json')
+        if is_json:
+            try:
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError("expected a json object")
+                top_k = request.get('top_k', top_k)
+                if not isinstance(top_k, int) or top_k < 1:
+                    raise ValueError("top_k must be a positive integer")
+                filters = normalize_filters(request.get('filters'))
+                if 'path' not in request:
+                    raise ValueError("json requests need the path of an image")
+            except ValueError as e:
+                self.send_json(400, {'error': f'Bad request: {e}'})
+                return
+        try:
+            if is_json:
+                with open(request['path'], 'rb') as image_file:
+                    data = image_file.read()
+            else:
+                data = body
+        except OSError as e:
+            self.send_json(400, {'error': f"Couldn't read query image: {e}"})
+            return
+
+        metrics.count('queries')
+        hash_functions = self.watcher.refresh()
+        # The same image bytes again don't even need decoding
+        image_key = get_image_key(data, filters)
+        results = self.cache.get(image_key, top_k)
+        if results is not None:
+            self.send_json(200, {'results': results})
+            return
+
+        try:
+            with metrics.timer('image_load'):
+                image = Image.open(io.BytesIO(data)).convert('RGB').resize(card_size)
+        except OSError as e:
+            self.send_json(400, {'error': f"Couldn't read query image: {e}"})
+            return
+
+        reference_hashes = get_reference_hashes(image, "reference_card", hash_functions)
+        hex_dict = {hash_result.hash_function.id: str(hash_result.value) for hash_result in reference_hashes}
+        hashes_key = get_hashes_key(hex_dict, hash_functions, filters)
+        results = self.cache.get(hashes_key, top_k)
+        if results is None:
+            self.cache.miss()
+            try:
+                results = self.batcher.submit(reference_hashes, top_k, filters).result()
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+        self.cache.put([image_key, hashes_key], top_k, results)
+        self.send_json(200, {'results': results})
+
+def serve(host: str, port: int, index: HashIndex, batch_window: float, max_batch: int, hash_config: str = hash_config_path,
+        index_file: str = index_path, cache_size: int = default_max_entries, collapse_sides: bool = False):
+    hash_functions = load_hash_config(get_hash_functions(index.registry), hash_config)
+    RecognitionHandler.batcher = QueryBatcher(index, hash_functions, batch_window, max_batch, collapse_sides)
+    RecognitionHandler.cache = ResultCache(cache_size)
+    RecognitionHandler.watcher = IndexWatcher(index_file, hash_config, RecognitionHandler.batcher, RecognitionHandler.cache)
+    server = ThreadingHTTPServer((host, port), RecognitionHandler)
+    print(f'Serving {len(index)} card sides on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve card recognition over HTTP from a warm in-memory index')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db, used if the index needs rebuilding')
+    parser.add_argument('--index', help='Path to the hash index. Defaults to <db>.index')
+    parser.add_argument('--batch-window-ms', type=float, default=5, help='How long to wait for more queries to batch together')
+    parser.add_argument('--hash-config', default=hash_config_path, help='Hash function subset and weights from select_hashes.py')
+    parser.add_argument('--max-batch', type=int, default=32, help='Most queries scored in one pass')
+    parser.add_argument('--cache-size', type=int, default=default_max_entries, help='Query results kept for repeated images')
+    parser.add_argument('--collapse-sides', action='store_true', help="Only list each card's best matching side")
+    args = parser.parse_args()
+
+    index_file = args.index or get_index_path(args.db)
+    index = load_or_build_index(index_file, args.db)
+    serve(args.host, args.port, index, args.batch_window_ms / 1000, args.max_batch, args.hash_config, index_file, args.cache_size,
+        args.collapse_sides)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import numpy
+
+# Remembers the top-k results of recent queries so repeated scans skip the work.
+#
+# Entries are looked up by the exact bytes of the query image first, which skips decoding
+# and hashing, and then by the tuple of reference hashes, which catches re-encoded or
+# re-cropped copies of a frame that hash the same. Both keys of a query point at the same
+# results. The cache holds at most max_entries keys, evicting the least recently used.
+#
+# Every entry belongs to the index and hash functions it was scored with. Checking a
+# different fingerprint (see get_fingerprint) empties the cache.
+
+default_max_entries = 4096
+
+# Filtered queries are cached separately, see HashIndex.filter_rows
+def get_filters_key(filters: dict) -> str:
+    return json.dumps(filters or {}, sort_keys=True)
+
+def get_image_key(data: bytes, filters: dict = None) -> tuple:
+    return ('image', hashlib.sha1(data).hexdigest(), get_filters_key(filters))
+
+# Reference hashes in hash function order, as a hashable key
+def get_hashes_key(hex_dict: dict, hash_functions, filters: dict = None) -> tuple:
+    return ('hashes', get_filters_key(filters)) + tuple(hex_dict[hash_function.id] for hash_function in hash_functions)
+
+# Identifies an index and the weighted hash functions queries are scored with. Changes
+# whenever the index is rebuilt with different rows or hashes, or the hash config changes.
+def get_fingerprint(index, hash_functions) -> str:
+    digest = hashlib.sha1(json.dumps(index.registry, sort_keys=True).encode('UTF-8'))
+    digest.update(json.dumps([(hash_function.id, hash_function.weight) for hash_function in hash_functions]).encode('UTF-8'))
+    for id in index.hash_function_ids:
+        digest.update(numpy.ascontiguousarray(index.matrices[id]).data)
+    digest.update(numpy.ascontiguousarray(index.row_offsets).data)
+    digest.update(bytes(index.row_blob))
+    return digest.hexdigest()
+
+class ResultCache(object):
+    def __init__(self, max_entries: int = default_max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (top_k, results)
+        self.fingerprint = None
+        self.lock = threading.Lock()
+        self.image_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Empties the cache if it was filled from a different index or hash config
+    def check(self, fingerprint: str):
+        with self.lock:
+            if fingerprint != self.fingerprint:
+                if self.fingerprint is not None:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.fingerprint = fingerprint
+
+    # Results for key if at least top_k of them were cached, otherwise None.
+    # Misses are only counted by miss(), since one query can check both of its keys.
+    def get(self, key: tuple, top_k: int):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < top_k:
+                return None
+            self.entries.move_to_end(key)
+        self.hit(key)
+        return entry[1][:top_k]
+
+    # Counts a hit that was answered without going through get, e.g. a duplicate within a batch
+    def hit(self, key: tuple):
+        with self.lock:
+            if key[0] == 'image':
+                self.image_hits += 1
+            else:
+                self.hash_hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def put(self, keys: list[tuple], top_k: int, results: list):
+        with self.lock:
+            for key in keys:
+                self.entries[key] = (top_k, results)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.image_hits + self.hash_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'image_hits': self.image_hits,
+                'hash_hits': self.hash_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.image_hits + self.hash_hits) / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import codecs
+import json
+import os
+
+# Maps (set_name, name) to scryfall card id so library paths can be resolved without
+# scanning the whole bulk file per image, and card id to the metadata_fields queries
+# can be filtered on. Names include each face of a multi faced card,
+# under the same file name download_images gives the face image, as well as the full
+# card name that double sided cards' directories are named after.
+#
+# The tables are cached next to the bulk file as <bulk file>.index.json and rebuilt
+# whenever the bulk file's size or mtime changes.
+
+metadata_fields = ['colors', 'layout', 'released_at']
+
+bulk_chunk_size = 1 << 20 # Bytes read from the bulk file at a time
+
+# Bulk files are one big json array of card objects, gigabytes for default_cards and
+# all_cards. Rather than parsing the array whole, card objects are decoded one at a time
+# out of a buffer that only ever holds the current chunk, so memory use doesn't grow
+# with the file.
+
+# Yields the card objects of a bulk file's json array from an iterable of utf-8 byte chunks
+def iter_card_objects(chunks):
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    finished = False
+    while True:
+        # Skip the array's punctuation up to the next object
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            if buffer[position] == '[':
+                started = True
+            position += 1
+        if position < len(buffer):
+            if not started:
+                raise ValueError('Bulk file is not a json array')
+            if buffer[position] == ']':
+                return
+            try:
+                card_obj, end = decoder.raw_decode(buffer, position)
+                position = end
+                yield card_obj
+                continue
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                # The object runs on into the next chunk
+        elif finished:
+            raise ValueError('Bulk file ended before its json array was closed')
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            buffer = buffer[position:] + utf8.decode(b'', final=True)
+        else:
+            buffer = buffer[position:] + utf8.decode(chunk)
+        position = 0
+
+def iter_bulk_file(bulk_path: str):
+    with open(bulk_path, 'rb') as bulk_file:
+        yield from iter_card_objects(iter(lambda: bulk_file.read(bulk_chunk_size), b''))
+
+# Newest bulk file of the given type (e.g. oracle_cards) in directory, or None
+def find_bulk_file(bulk_type: str, directory: str = '.'):
+    prefix = bulk_type.replace('_', '-') + '-'
+    # Skips the lookups cached next to bulk files
+    files = sorted(file for file in os.listdir(directory)
+        if file.startswith(prefix) and file.endswith('.json') and not file.endswith('.index.json'))
+    return os.path.join(directory, files[-1]) if files else None
+
+def get_lookup_path(bulk_path: str) -> str:
+    return bulk_path + '.index.json'
+
+# Yields (name, face) for every face of a multi faced scryfall card object.
+# Faces that share the front's name (e.g. art series cards) get .back appended,
+# which is what the image for that face is saved as.
+def get_face_names(card_obj: dict):
+    card_faces = card_obj.get('card_faces', [])
+    for index, face in enumerate(card_faces):
+        face_name = face['name']
+        if index > 0 and face_name == card_faces[0]['name']:
+            face_name += '.back'
+        yield face_name, face
+
+def get_source_stamp(bulk_path: str) -> dict:
+    stat = os.stat(bulk_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+# The metadata_fields of a card object. Multi faced cards only have colours on their faces,
+# so those are merged. Colourless cards get ['C'] so they can be filtered on too.
+def get_card_metadata(card_obj: dict) -> dict:
+    metadata = {field: card_obj[field] for field in metadata_fields if field in card_obj}
+    if 'colors' not in metadata and 'card_faces' in card_obj:
+        colors = set()
+        for face in card_obj['card_faces']:
+            colors.update(face.get('colors', []))
+        metadata['colors'] = sorted(colors)
+    if metadata.get('colors') == []:
+        metadata['colors'] = ['C']
+    return metadata
+
+# Returns the (set_name, name) -> id lookup and the id -> metadata table
+def build_lookup(card_objs):
+    lookup = {}
+    metadata = {}
+    for card_obj in card_objs:
+        names = lookup.setdefault(card_obj['set_name'], {})
+        names.setdefault(card_obj['name'], card_obj['id'])
+        for face_name, _ in get_face_names(card_obj):
+            names.setdefault(face_name, card_obj['id'])
+        metadata[card_obj['id']] = get_card_metadata(card_obj)
+    return lookup, metadata
+
+def save_lookup(bulk_path: str, lookup: dict, metadata: dict):
+    lookup_path = get_lookup_path(bulk_path)
+    tmp_path = lookup_path + '.tmp'
+    with open(tmp_path, 'w') as lookup_file:
+        json.dump({'source': get_source_stamp(bulk_path), 'cards': lookup, 'metadata': metadata}, lookup_file)
+    os.replace(tmp_path, lookup_path)
+
+# Loads the cached tables for bulk_path, rebuilding them by streaming the bulk file if it changed
+def load_tables(bulk_path: str) -> dict:
+    lookup_path = get_lookup_path(bulk_path)
+    if os.path.isfile(lookup_path):
+        with open(lookup_path, 'r') as lookup_file:
+            cached = json.load(lookup_file)
+        # Caches from before metadata was kept are rebuilt too
+        if cached['source'] == get_source_stamp(bulk_path) and 'metadata' in cached:
+            return cached
+
+    print(f'Building card lookup for {bulk_path}')
+    lookup, metadata = build_lookup(iter_bulk_file(bulk_path))
+    save_lookup(bulk_path, lookup, metadata)
+    return {'cards': lookup, 'metadata': metadata}
+
+def load_lookup(bulk_path: str) -> dict:
+    return load_tables(bulk_path)['cards']
+
+def load_metadata(bulk_path: str) -> dict:
+    return load_tables(bulk_path)['metadata']
+
+def get_card_id(lookup: dict, set_name: str, *names: str):
+    names_in_set = lookup.get(set_name, {})
+    for name in names:
+        id = names_in_set.get(name)
+        if id:
+            return id
+    return None
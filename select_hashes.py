@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+from PIL import Image
+import argparse
+import csv
+import json
+import os
+import random
+import time
+import numpy
+import generate_database
+from hash_index import load_or_build_index, get_index_path
+from image_pipeline import prepare_image
+from compare_images import get_hash_functions, pretty_time_delta, card_size, db_path, hash_config_path
+from benchmark import perturb, perturbations
+
+# Measures what each registered HashFunction costs and how well it tells cards apart on a
+# labelled query set, then recommends a subset and per hash weights for the scorer.
+#
+# For every query and hash function the distance to the true card (d_true) is compared to
+# the distance to the closest other card (d_other). A hash's weight is its mean separation
+# (d_other - d_true) / bits, scaled so the weights average 1. The subset is grown greedily,
+# each step adding the hash with the best top-1 accuracy gain per millisecond of hashing,
+# until nothing improves accuracy. The result is written to hash_config.json, which
+# compare_images, recognition_server and batch_compare pick up via load_hash_config.
+
+default_queries = 200
+
+# Labelled queries from a csv of image,card_id rows
+def load_labelled_queries(labels_path: str) -> list[tuple]:
+    queries = []
+    base_dir = os.path.dirname(labels_path)
+    with open(labels_path, newline='') as labels_file:
+        for row in csv.DictReader(labels_file):
+            image = Image.open(os.path.join(base_dir, row['image'])).convert('RGB').resize(card_size)
+            queries.append((row['card_id'], image))
+    return queries
+
+# Perturbed copies of random library images, labelled from the db manifest
+def make_synthetic_queries(count: int, seed: int, manifest_path: str = generate_database.manifest_path) -> list[tuple]:
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    rng = random.Random(seed)
+    relpaths = sorted(manifest.keys())
+    queries = []
+    for i in range(count):
+        relpath = rng.choice(relpaths)
+        image = Image.open(os.path.join(generate_database.library_path, relpath)).convert('RGB').resize(card_size)
+        queries.append((manifest[relpath]['id'], perturb(image, perturbations[i % len(perturbations)], rng)))
+    return queries
+
+# Top-1 accuracy of the weighted sum of the given hashes' normalized deltas
+def get_accuracy(normalized_deltas: dict, weights: dict, hash_function_ids: list[str], true_rows: numpy.ndarray) -> float:
+    if len(hash_function_ids) == 0:
+        return 0
+    total = sum(weights[id] * normalized_deltas[id] for id in hash_function_ids)
+    best = numpy.argmin(total, axis=1)
+    return float(true_rows[numpy.arange(len(best)), best].mean())
+
+def select_hashes(queries: list[tuple], index, hash_functions) -> dict:
+    row_card_ids = [index.card_ids(row) for row in range(len(index))]
+    # true_rows[q, row] is True where row is a side of query q's card, or of a near duplicate cluster it's in
+    true_rows = numpy.stack([[card_id in card_ids for card_ids in row_card_ids] for card_id, _ in queries])
+    if not true_rows.any(axis=1).all():
+        raise Exception("Some labelled cards aren't in the index")
+
+    prepare_time = 0
+    prepared_images = []
+    for _, image in queries:
+        start = time.perf_counter()
+        prepared_images.append(prepare_image(image))
+        prepare_time += time.perf_counter() - start
+
+    metrics = {}
+    normalized_deltas = {}
+    for hash_function in hash_functions:
+        bits = index.bits(hash_function.id)
+        start = time.perf_counter()
+        hexes = [str(hash_function.hash(prepared_image, "reference_card").value) for prepared_image in prepared_images]
+        cost = (time.perf_counter() - start) / len(queries)
+
+        queries_packed = numpy.stack([index.pack_query(hash_function.id, hex) for hex in hexes])
+        deltas = index.batch_distances(hash_function.id, queries_packed).astype(numpy.float32)
+        d_true = numpy.where(true_rows, deltas, numpy.inf).min(axis=1)
+        d_other = numpy.where(true_rows, numpy.inf, deltas).min(axis=1)
+        normalized_deltas[hash_function.id] = deltas / bits # Same as the scorer
+        metrics[hash_function.id] = {
+            'id': hash_function.id,
+            'name': hash_function.name,
+            'hash_size': hash_function.hash_size,
+            'cost_ms': round(cost * 1000, 4),
+            'top_1': round(float((d_true < d_other).mean()), 4),
+            'separation': round(float(((d_other - d_true) / bits).mean()), 4)
+        }
+
+    positive = [max(metric['separation'], 0) for metric in metrics.values()]
+    mean_separation = sum(positive) / len(positive) if sum(positive) > 0 else 1
+    weights = {id: max(metric['separation'], 0) / mean_separation for id, metric in metrics.items()}
+    for id, metric in metrics.items():
+        metric['weight'] = round(weights[id], 4)
+
+    all_ids = [hash_function.id for hash_function in hash_functions if weights[hash_function.id] > 0]
+    all_accuracy = get_accuracy(normalized_deltas, weights, all_ids, true_rows)
+
+    selected = []
+    accuracy = 0
+    while True:
+        best_id = None
+        best_gain_per_ms = 0
+        for id in all_ids:
+            if id in selected:
+                continue
+            gain = get_accuracy(normalized_deltas, weights, selected + [id], true_rows) - accuracy
+            gain_per_ms = gain / max(metrics[id]['cost_ms'], 1e-3)
+            if gain > 0 and gain_per_ms > best_gain_per_ms:
+                best_id = id
+                best_gain_per_ms = gain_per_ms
+        if best_id is None:
+            break
+        selected.append(best_id)
+        accuracy = get_accuracy(normalized_deltas, weights, selected, true_rows)
+        if accuracy >= all_accuracy:
+            break
+
+    if len(selected) == 0:
+        print("No hash function beat chance on these queries, keeping all of them")
+        selected = all_ids
+
+    return {
+        'hash_functions': [{'id': id, 'name': metrics[id]['name'], 'weight': metrics[id]['weight']} for id in selected],
+        'queries': len(queries),
+        'prepare_ms': round(prepare_time / len(queries) * 1000, 4),
+        'top_1': round(accuracy, 4),
+        'all_hashes_top_1': round(all_accuracy, 4),
+        'selected_cost_ms': round(sum(metrics[id]['cost_ms'] for id in selected), 4),
+        'all_hashes_cost_ms': round(sum(metric['cost_ms'] for metric in metrics.values()), 4),
+        'metrics': list(metrics.values())
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recommend a hash function subset and weights from measured cost and accuracy')
+    parser.add_argument('--labels', help='csv with image,card_id columns of labelled query photos. Perturbed library images are used if not given')
+    parser.add_argument('--queries', type=int, default=default_queries, help='Number of synthetic queries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=hash_config_path)
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    args = parser.parse_args()
+
+    start = time.time()
+    index = load_or_build_index(args.index or get_index_path(args.db), args.db)
+    hash_functions = get_hash_functions(index.registry)
+    if args.labels:
+        queries = load_labelled_queries(args.labels)
+    else:
+        queries = make_synthetic_queries(args.queries, args.seed, args.db + '.manifest')
+    config = select_hashes(queries, index, hash_functions)
+    with open(args.output, 'w') as config_file:
+        json.dump(config, config_file, indent=2)
+
+    for metric in config['metrics']:
+        print(f"{metric['name']} ({metric['hash_size']}): {metric['cost_ms']}ms top-1 {metric['top_1']} weight {metric['weight']}")
+    print(f"Selected {len(config['hash_functions'])}/{len(hash_functions)} hashes: top-1 {config['top_1']} (all: {config['all_hashes_top_1']}), "
+        f"{config['selected_cost_ms']}ms per query (all: {config['all_hashes_cost_ms']}ms)")
+    end = time.time()
+    print(pretty_time_delta(end - start))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+from PIL import Image
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import imagehash
+from hash_index import load_or_build_index, get_index_path
+from card_detection import find_card_corners, warp_card
+from batch_compare import get_query_paths
+import metrics as metrics_module
+from metrics import metrics
+from compare_images import get_hash_functions, load_hash_config, identify_orientation, parse_filters, \
+    pretty_time_delta, default_accept_distance, default_accept_margin, db_path, hash_config_path
+
+# Identifies cards passing under a camera from a stream of frames: a video file (decoded by
+# ffmpeg), an image sequence, or raw PPM frames piped in on stdin, e.g.
+#   ffmpeg -f v4l2 -i /dev/video0 -f image2pipe -vcodec ppm - | stream_identify.py -
+#
+# Every frame gets a cheap 64 bit dhash of a thumbnail of the whole frame. While it keeps
+# changing from one frame to the next something is moving and the frame is skipped. Once it
+# has stayed within motion_threshold bits for settle_frames frames the view has settled,
+# and the full detection and identification runs once on that frame. A view that settles
+# again without ever having moved away from the last identified one (the same card, a
+# little jitter) isn't identified again. Once any frame differs from the identified view by
+# more than motion_threshold bits it's forgotten, so the next copy of the same card passing
+# by is identified too.
+#
+# Results are written as one json event per line on stdout:
+#   {"event": "card", "frame": 120, "rotation": 90, "distance": ..., "margin": ..., "results": [...]}
+#     ambiguous is true when the best match has near duplicates, listed in its result's duplicates
+#   {"event": "empty", "frame": 180} when the view settles with no card in it
+
+default_motion_threshold = 4 # Bits of the cheap hash that may flip between frames of a still view
+default_settle_frames = 3
+default_top_k = 5
+thumbnail_width = 160 # Frames are shrunk to about this wide before the cheap hash
+
+# Reads PPM (P6) frames back to back from a binary stream until it ends
+def iter_ppm_frames(stream):
+    while True:
+        tokens = []
+        while len(tokens) < 4:
+            line = stream.readline()
+            if not line:
+                return
+            tokens.extend(line.split(b'#')[0].split())
+        magic, width, height, maxval = tokens
+        if magic != b'P6' or int(maxval) > 255:
+            raise ValueError(f"Expected 8 bit P6 frames, got {magic.decode()} with maxval {int(maxval)}")
+        size = (int(width), int(height))
+        data = stream.read(size[0] * size[1] * 3)
+        if len(data) < size[0] * size[1] * 3:
+            return # Stream cut off mid frame
+        yield Image.frombytes('RGB', size, data)
+
+# Decodes a video file with ffmpeg, piping its frames out as PPM
+def iter_video_frames(path: str):
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-i', path, '-f', 'image2pipe', '-vcodec', 'ppm', '-'],
+        stdout=subprocess.PIPE)
+    try:
+        yield from iter_ppm_frames(process.stdout)
+    finally:
+        process.stdout.close()
+        process.terminate()
+        process.wait()
+
+def iter_image_frames(paths: list[str]):
+    for path in paths:
+        yield Image.open(path).convert('RGB')
+
+# Frames from '-' (PPM on stdin), a directory or glob of images, or a video file
+def get_frames(source: str):
+    if source == '-':
+        return iter_ppm_frames(sys.stdin.buffer)
+    if os.path.isdir(source) or not os.path.isfile(source):
+        return iter_image_frames(get_query_paths([source]))
+    return iter_video_frames(source)
+
+def get_cheap_hash(frame: Image.Image) -> imagehash.ImageHash:
+    thumbnail = frame.convert('L').reduce(max(1, frame.width // thumbnail_width))
+    return imagehash.dhash(thumbnail)
+
+class StreamIdentifier(object):
+    def __init__(self, index, hash_functions, rows=None, motion_threshold: int = default_motion_threshold,
+            settle_frames: int = default_settle_frames, top_k: int = default_top_k,
+            accept_distance: float = default_accept_distance, accept_margin: float = default_accept_margin,
+            collapse_sides: bool = False, filters: dict = None):
+        self.index = index
+        self.hash_functions = hash_functions
+        self.rows = rows
+        self.motion_threshold = motion_threshold
+        self.settle_frames = settle_frames
+        self.top_k = top_k
+        self.accept_distance = accept_distance
+        self.accept_margin = accept_margin
+        self.collapse_sides = collapse_sides
+        self.filters = filters # The filters rows came from, to report the cluster member that matched them
+        self.previous_hash = None
+        self.still_frames = 0
+        self.identified_hash = None # Cheap hash of the last view that was identified
+        self.frames = 0
+        self.identifications = 0
+
+    # Feeds one frame in. Returns an event dict when a newly settled view was identified, otherwise None.
+    def process(self, frame_index: int, frame: Image.Image):
+        self.frames += 1
+        metrics.count('frames')
+        with metrics.timer('frame_hash'):
+            cheap_hash = get_cheap_hash(frame)
+        moving = self.previous_hash is None or cheap_hash - self.previous_hash > self.motion_threshold
+        self.previous_hash = cheap_hash
+        if self.identified_hash is not None and cheap_hash - self.identified_hash > self.motion_threshold:
+            self.identified_hash = None # The identified card has left the view
+        if moving:
+            self.still_frames = 0
+            return None
+        self.still_frames += 1
+        if self.still_frames != self.settle_frames:
+            return None
+        if self.identified_hash is not None:
+            return None # Same view as last time, it only wobbled
+        self.identified_hash = cheap_hash
+        return self.identify(frame_index, frame)
+
+    def identify(self, frame_index: int, frame: Image.Image) -> dict:
+        self.identifications += 1
+        metrics.count('identifications')
+        with metrics.timer('detect'):
+            corners = find_card_corners(frame)
+        if corners is None:
+            return {'event': 'empty', 'frame': frame_index}
+        rotation, match = identify_orientation(warp_card(frame, corners), self.hash_functions, self.index, self.rows,
+            self.accept_distance, self.accept_margin)
+        results = []
+        for position in match.top_k(self.top_k, self.collapse_sides):
+            result = self.index.row(match.row(position), self.filters)
+            result['distance'] = round(float(match.distances[position]), 4)
+            results.append(result)
+        return {
+            'event': 'card',
+            'frame': frame_index,
+            'rotation': rotation,
+            'distance': round(float(match.distances[match.best]), 4),
+            'margin': round(match.margin, 4),
+            'accepted': match.accepted,
+            'ambiguous': match.ambiguous,
+            'results': results
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Identify cards as they settle in view of a camera or video')
+    parser.add_argument('source', help="Video file, directory or glob of frame images, or - for PPM frames on stdin")
+    parser.add_argument('--motion-threshold', type=int, default=default_motion_threshold, help='Bits of the 64 bit frame hash that can change between frames of a still view')
+    parser.add_argument('--settle-frames', type=int, default=default_settle_frames, help='Still frames before a view counts as settled')
+    parser.add_argument('--top-k', type=int, default=default_top_k)
+    parser.add_argument('--hash-config', default=hash_config_path, help='Hash function subset and weights from select_hashes.py')
+    parser.add_argument('--db', default=db_path, help='db.json, or a .sqlite db from generate_database --db')
+    parser.add_argument('--index', help='Defaults to <db>.index')
+    parser.add_argument('--filter', action='append', help='Only match cards with this metadata, e.g. "set_name=Core Set 2021". Can be repeated')
+    parser.add_argument('--accept-distance', type=float, default=default_accept_distance)
+    parser.add_argument('--accept-margin', type=float, default=default_accept_margin)
+    parser.add_argument('--collapse-sides', action='store_true', help="Only list each card's best matching side")
+    metrics_module.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics_module.run(args.metrics, args.profile):
+        start = time.time()
+        index = load_or_build_index(args.index or get_index_path(args.db), args.db)
+        hash_functions = load_hash_config(get_hash_functions(index.registry), args.hash_config)
+        filters = parse_filters(args.filter)
+        rows = index.filter_rows(filters)
+        if rows is not None and len(rows) == 0:
+            raise Exception("No cards match the filters")
+        identifier = StreamIdentifier(index, hash_functions, rows, args.motion_threshold, args.settle_frames, args.top_k,
+            args.accept_distance, args.accept_margin, args.collapse_sides, filters)
+
+        for frame_index, frame in enumerate(get_frames(args.source)):
+            event = identifier.process(frame_index, frame)
+            if event:
+                print(json.dumps(event), flush=True)
+        end = time.time()
+        print(f'{identifier.frames} frames, {identifier.identifications} identified, '
+            f'{identifier.frames - identifier.identifications} skipped in {pretty_time_delta(end - start)}', file=sys.stderr)